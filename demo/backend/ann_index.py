@@ -0,0 +1,251 @@
+"""
+ANN / 압축 인덱스(IVF / HNSW / SQ8 / PQ) 생성 + recall / 지연시간 / 크기 벤치마크
+
+flat 인덱스(index.faiss)의 벡터로 카테고리별 인덱스를 만들어
+같은 폴더에 index.<variant>.faiss 로 저장한다.
+서버는 FAISS_INDEX_VARIANT=<variant> 로 이 파일을 읽고 (없으면 flat),
+검색 파라미터는 FAISS_NPROBE / FAISS_EF_SEARCH 로 조절한다.
+sq8 / pq는 FAISS_RESCORE=1(기본)이면 후보를 flat 벡터로 exact 재스코어링한다.
+
+bench는 페르소나 스타일 쿼리 + TPO 쿼리를 두 종류의 필터(IDSelector)와 함께 재생해
+exact(flat) 대비 recall@k, 검색 p50 / p99 지연시간, 인덱스 파일 크기를 출력한다.
+    - persona: 페르소나 기본 비트셋 (성별 + 스트릿 제외)
+    - tight  : 색상 / 서브카테고리 hard constraints + negatives + 가격 상한 (eligible row가 적은 경우)
+서버는 eligible row가 FAISS_EXACT_SCAN_MAX 이하면 ANN 대신 exact 스캔을 하지만,
+여기서는 exact 스캔 없이 ANN 인덱스 자체의 recall(HNSW efSearch 확장 포함)을 측정한다.
+
+사용법:
+    python ann_index.py build --variant ivf --nlist 16
+    python ann_index.py build --variant hnsw --hnsw-m 32 --ef-construction 200
+    python ann_index.py build --variant sq8
+    python ann_index.py build --variant pq --pq-m 64
+    python ann_index.py bench --variants ivf hnsw sq8 pq --topk 5 --nprobe 4 8 16 --ef-search 16 32 64
+"""
+import argparse
+import contextlib
+import io
+import math
+import os
+import time
+
+import faiss
+import numpy as np
+
+from utils import *
+from bench_retrieval import BENCH_TPO_QUERIES, STYLE_DB_ROOT, TPO_DB_ROOT
+
+CATEGORY_ORDER = ["상의", "아우터", "바지", "신발", "가방"]
+
+
+def db_dirs(categories):
+    for kind, root in (("style", STYLE_DB_ROOT), ("tpo", TPO_DB_ROOT)):
+        for cat in categories:
+            db_dir = os.path.join(root, cat)
+            if os.path.exists(os.path.join(db_dir, index_file_name("flat"))):
+                yield kind, cat, db_dir
+
+
+def flat_vectors(db_dir):
+    index = read_faiss_index(os.path.join(db_dir, index_file_name("flat")))
+    return index.reconstruct_n(0, index.ntotal)
+
+
+def default_nlist(n):
+    # 클러스터당 학습 벡터 39개 이상 (faiss 권장) + 4 * sqrt(n) 이하
+    return max(1, min(n // 39, int(4 * math.sqrt(n))))
+
+
+def pq_nbits(n):
+    # 서브 양자화기당 centroid 2^nbits개 <= 학습 벡터 수
+    return max(1, min(8, int(math.log2(n))))
+
+
+def build_ann_index(xb, args):
+    d = xb.shape[1]
+    if args.variant == "sq8":
+        index = faiss.IndexScalarQuantizer(d, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+        index.train(xb)
+        index.add(xb)
+        return index, f"{index.sa_code_size()}B/vec"
+
+    if args.variant == "pq":
+        # IndexPQ는 IDSelector(필터 pushdown)를 지원하지 않으므로 IVF-PQ로 생성
+        nlist = args.nlist or default_nlist(len(xb))
+        nbits = pq_nbits(len(xb))
+        quantizer = faiss.IndexFlatIP(d)
+        index = faiss.IndexIVFPQ(quantizer, d, nlist, args.pq_m, nbits, faiss.METRIC_INNER_PRODUCT)
+        index.pq.cp.min_points_per_centroid = 1  # 카테고리당 상품 수가 적어 centroid당 학습 벡터가 부족함 (경고 억제)
+        index.train(xb)
+        index.add(xb)
+        return index, f"nlist={nlist}, M={args.pq_m}, nbits={nbits}, {index.pq.code_size}B/vec"
+
+    if args.variant == "ivf":
+        nlist = args.nlist or default_nlist(len(xb))
+        quantizer = faiss.IndexFlatIP(d)
+        index = faiss.IndexIVFFlat(quantizer, d, nlist, faiss.METRIC_INNER_PRODUCT)
+        index.train(xb)
+        index.add(xb)
+        return index, f"nlist={nlist}"
+
+    index = faiss.IndexHNSWFlat(d, args.hnsw_m, faiss.METRIC_INNER_PRODUCT)
+    index.hnsw.efConstruction = args.ef_construction
+    index.add(xb)
+    return index, f"M={args.hnsw_m}, efConstruction={args.ef_construction}"
+
+
+def build(args):
+    print(f"👉 Building {args.variant} indices...")
+    for kind, cat, db_dir in db_dirs(args.categories):
+        xb = flat_vectors(db_dir)
+        start = time.perf_counter()
+        index, desc = build_ann_index(xb, args)
+        out_path = os.path.join(db_dir, index_file_name(args.variant))
+        # 서버가 mmap 중이거나 카탈로그 리로드가 읽는 중일 수 있으므로 임시 파일에 쓴 뒤 교체
+        tmp_path = f"{out_path}.tmp.{os.getpid()}"
+        faiss.write_index(index, tmp_path)
+        os.replace(tmp_path, out_path)
+        print(f"  ✅ {kind}/{cat}: n={len(xb)}, {desc}, {time.perf_counter() - start:.2f}s → {out_path}")
+
+
+def bench_queries(model):
+    queries = [safe_join(PERSONA_MOOD[p]) for p in PERSONA_MOOD] + BENCH_TPO_QUERIES
+    return embed_texts(queries, model)
+
+
+# tight 필터: (hard constraints, negatives) - 서브카테고리는 DB마다 가장 흔한 값으로 채움
+TIGHT_FILTERS = [
+    ({"preferred_colors": ["블랙"]}, {"fit": ["오버사이즈"], "pattern": [], "price_threshold": 200000}),
+    ({"preferred_colors": ["화이트", "크림", "아이보리"]}, {"fit": [], "pattern": ["로고"], "price_threshold": 100000}),
+    ({"forced_sub_categories": None, "preferred_colors": ["블랙"]}, init_negatives()),
+]
+
+
+def tight_selectors(attr_index):
+    """페르소나 × TIGHT_FILTERS 비트셋 (eligible row가 없는 조합은 제외)"""
+    sub_cats = attr_index.postings.get("sub_cat_name", {})
+    top_sub_cat = max(
+        (v for v in sub_cats if v is not None), key=lambda v: AttributeIndex.count(sub_cats[v]), default=None
+    )
+    selectors = []
+    for persona in PERSONA_MOOD:
+        for constraints, negatives in TIGHT_FILTERS:
+            hard_constraints = init_hard_constraints()
+            for key, values in constraints.items():
+                hard_constraints[key] = values if values is not None else [top_sub_cat]
+            bits = build_eligibility_bitset(attr_index, persona, GENDER_MAP[persona], negatives, hard_constraints)
+            if AttributeIndex.count(bits) > 0:
+                selectors.append(bits)
+    return selectors
+
+
+def run_searches(index, qvecs, selectors, topk, **param_kwargs):
+    """(필터 비트셋 × 쿼리) 검색 → (결과 score 리스트, 지연시간 리스트)"""
+    results, latencies = [], []
+    for bits in selectors:
+        n_eligible = AttributeIndex.count(bits)
+        for q in qvecs:
+            params = faiss_search_params(index, bits, topk, n_eligible=n_eligible, **param_kwargs)
+            start = time.perf_counter()
+            D, I = index.search(q.reshape(1, -1), topk, params=params)
+            latencies.append(time.perf_counter() - start)
+            results.append(D[0][I[0] >= 0])
+    return results, latencies
+
+
+def recall_at_k(exact, approx, topk, eps=1e-5):
+    """
+    score 기준 recall@k: exact top-k의 마지막 score 이상인 결과 비율
+    (카탈로그에 같은 벡터가 많아 id 교집합은 동점 순서에 따라 과소평가됨)
+    """
+    recalls = []
+    for e, a in zip(exact, approx):
+        if len(e) == 0:
+            continue
+        hits = int(np.sum(a >= e[-1] - eps))
+        recalls.append(min(hits, len(e)) / len(e))
+    return float(np.mean(recalls)) if recalls else 1.0
+
+
+def print_row(db, variant, label, filters, recall, lat, size_mb):
+    print(
+        f"{db:<14} {variant:<10} {label:<14} {filters:<8} {recall:>8.3f} "
+        f"{np.percentile(lat, 50) * 1000:>9.3f} {np.percentile(lat, 99) * 1000:>9.3f} {size_mb:>9.2f}"
+    )
+
+
+def bench(args):
+    model = load_embedding_model()
+    qvecs = bench_queries(model)
+
+    param_grid = {
+        "ivf": [{"nprobe": p} for p in args.nprobe],
+        "hnsw": [{"ef_search": ef} for ef in args.ef_search],
+        "pq": [{"nprobe": p} for p in args.nprobe],
+    }
+
+    print(f"\n=== ANN BENCH (n_queries={len(qvecs)} x personas={len(PERSONA_MOOD)}, top{args.topk}) ===")
+    print(f"{'db':<14} {'variant':<10} {'param':<14} {'filter':<8} {'recall':>8} {'p50(ms)':>9} {'p99(ms)':>9} {'size(MB)':>9}")
+    for kind, cat, db_dir in db_dirs(args.categories):
+        flat_path = os.path.join(db_dir, index_file_name("flat"))
+        with contextlib.redirect_stdout(io.StringIO()):
+            flat, metas = load_db(db_dir, variant="flat")
+        attr_index = build_attribute_index(metas)
+        filter_sets = {
+            "persona": [attr_index.persona_bits[p] for p in PERSONA_MOOD],
+            "tight": tight_selectors(attr_index),
+        }
+
+        exact = {}
+        for filters, selectors in filter_sets.items():
+            exact[filters], lat = run_searches(flat, qvecs, selectors, args.topk)
+            print_row(kind + "/" + cat if filters == "persona" else "", "flat", "-", filters, 1.0, lat, os.path.getsize(flat_path) / 2**20)
+
+        for variant in args.variants:
+            path = os.path.join(db_dir, index_file_name(variant))
+            if not os.path.exists(path):
+                print(f"{'':<14} {variant:<10} (없음: python ann_index.py build --variant {variant})")
+                continue
+            size_mb = os.path.getsize(path) / 2**20
+            index = read_faiss_index(path)
+
+            # 압축 variant는 재스코어링 전/후를 모두 측정
+            targets = [(variant, index)]
+            if variant in COMPRESSED_VARIANTS:
+                targets.append((variant + "+rs", faiss.IndexRefine(index, flat)))
+
+            for name, target in targets:
+                for params in param_grid.get(variant, [{}]):
+                    label = ",".join(f"{k}={v}" for k, v in params.items()) or "-"
+                    for filters, selectors in filter_sets.items():
+                        approx, lat = run_searches(target, qvecs, selectors, args.topk, **params)
+                        print_row("", name, label, filters, recall_at_k(exact[filters], approx, args.topk), lat, size_mb)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ANN index build / recall benchmark")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_build = sub.add_parser("build", help="write index.<variant>.faiss next to each flat index")
+    p_build.add_argument("--variant", required=True, choices=["ivf", "hnsw", "sq8", "pq"])
+    p_build.add_argument("--categories", nargs="+", default=CATEGORY_ORDER)
+    p_build.add_argument("--nlist", type=int, default=None, help="IVF / IVF-PQ cluster count (default: auto)")
+    p_build.add_argument("--hnsw-m", type=int, default=32)
+    p_build.add_argument("--ef-construction", type=int, default=200)
+    p_build.add_argument("--pq-m", type=int, default=64, help="PQ sub-quantizers (must divide the dimension)")
+
+    p_bench = sub.add_parser("bench", help="recall@k / latency against the flat index")
+    p_bench.add_argument("--variants", nargs="+", default=["ivf", "hnsw", "sq8", "pq"])
+    p_bench.add_argument("--categories", nargs="+", default=CATEGORY_ORDER)
+    p_bench.add_argument("--topk", type=int, default=5)
+    p_bench.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, FAISS_NPROBE])
+    p_bench.add_argument("--ef-search", type=int, nargs="+", default=[16, 32, FAISS_EF_SEARCH])
+
+    args = parser.parse_args()
+    if args.command == "build":
+        build(args)
+    else:
+        bench(args)
+
+
+if __name__ == "__main__":
+    main()
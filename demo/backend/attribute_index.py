@@ -0,0 +1,104 @@
+"""
+속성 역색인 (attribute value → row id 비트셋)
+
+카테고리 DB마다 로드 시 1회 생성한다.
+- 범주형 속성값마다 packed 비트셋(uint8, little bit order; FAISS IDSelectorBitmap과 같은 포맷)
+- 가격은 정렬된 배열 + argsort로 범위 컷
+
+hard constraints / negatives 조합은 비트셋 AND / OR 몇 번으로 끝나고,
+벡터 검색 전에 정확한 eligible 개수를 알 수 있다.
+"""
+import numpy as np
+
+from metadata_store import MISSING
+
+# 역색인을 만드는 속성 (main_color는 MetadataStore 파생 컬럼)
+INDEXED_FIELDS = ("gender", "style", "sub_cat_name", "fit", "pattern", "texture", "main_color")
+
+# 바이트별 popcount 테이블 (np.bitwise_count가 없는 numpy용)
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+class AttributeIndex:
+    def __init__(self, store, fields=INDEXED_FIELDS):
+        self.store = store
+        self.n = len(store)
+        self.nbytes = (self.n + 7) // 8
+
+        self.all = self.from_mask(np.ones(self.n, dtype=bool))
+        self.empty = np.zeros(self.nbytes, dtype=np.uint8)
+
+        # field -> {value -> bitset}
+        self.postings = {}
+        for name in fields:
+            if name not in store.vocabs:
+                continue
+            codes = store.columns[name]
+            postings = {
+                value: self.from_mask(codes == code)
+                for code, value in enumerate(store.vocabs[name])
+            }
+            postings[None] = self.from_mask(codes == MISSING)
+            self.postings[name] = postings
+
+        # 가격 범위 컷: 정렬된 가격 + 원래 row id
+        price = store.columns["price_raw"]
+        self.price_order = np.argsort(price, kind="stable")
+        self.price_sorted = price[self.price_order]
+
+        # 페르소나별 기본 비트셋 (utils.build_attribute_index에서 채움)
+        self.persona_bits = {}
+
+    # -------------------------------
+    # Bitset 변환
+    # -------------------------------
+    def from_mask(self, mask):
+        return np.packbits(mask, bitorder="little")
+
+    def from_ids(self, ids):
+        mask = np.zeros(self.n, dtype=bool)
+        mask[ids] = True
+        return self.from_mask(mask)
+
+    def to_mask(self, bits):
+        return np.unpackbits(bits, count=self.n, bitorder="little").astype(bool)
+
+    @staticmethod
+    def count(bits):
+        if hasattr(np, "bitwise_count"):
+            return int(np.bitwise_count(bits).sum())
+        return int(_POPCOUNT[bits].sum())
+
+    @staticmethod
+    def contains(bits, ids):
+        """ids 각각이 비트셋에 포함되는지 (bool 배열)"""
+        ids = np.asarray(ids, dtype=np.int64)
+        return ((bits[ids >> 3] >> (ids & 7).astype(np.uint8)) & 1).astype(bool)
+
+    # -------------------------------
+    # Posting 조회
+    # -------------------------------
+    def bitset(self, name, value):
+        """name == value 인 row 비트셋 (없는 값이면 빈 비트셋)"""
+        bits = self.postings.get(name, {}).get(value)
+        return bits if bits is not None else self.empty
+
+    def any_of(self, name, values):
+        """name이 values 중 하나인 row (OR)"""
+        bits = self.empty.copy()
+        for v in values:
+            bits |= self.bitset(name, v)
+        return bits
+
+    def contains_any(self, name, substrings):
+        """name 값에 substrings 중 하나라도 포함된 row (OR)"""
+        values = [
+            v for v in self.postings.get(name, {})
+            if v is not None and any(s in v for s in substrings)
+        ]
+        return self.any_of(name, values)
+
+    def price_at_most(self, threshold):
+        """price_raw <= threshold 인 row"""
+        pos = np.searchsorted(self.price_sorted, threshold, side="right")
+        return self.from_ids(self.price_order[:pos])
@@ -0,0 +1,104 @@
+"""
+Retrieval 지연시간 벤치마크
+
+기존 2회 encode 경로(retrieve_candidates_by_category)와
+style+TPO 배치 encode 경로(retrieve_candidates_by_category_batched)의
+요청당 지연시간을 비교한다. 임베딩 캐시는 끄고 모델 forward 비용만 측정.
+
+사용법:
+    python bench_retrieval.py --iters 30 --category 상의 --persona pme
+"""
+import argparse
+import contextlib
+import io
+import time
+
+import numpy as np
+
+from utils import *
+
+STYLE_DB_ROOT = "./faiss/style"
+TPO_DB_ROOT = "./faiss/tpo"
+
+BENCH_TPO_QUERIES = [
+    "1월에 회사 면접, 단정하고 깔끔한 면접룩",
+    "남자친구와 여행, 편안한 스타일, 예쁜 여친룩",
+    "대학교 수업, 친구와 저녁 약속",
+    "결혼식 하객룩",
+    "카페에서 공부, 캐주얼",
+]
+
+
+def percentile_ms(samples, q):
+    return float(np.percentile(samples, q) * 1000)
+
+
+def run_path(fn, args_list, iters):
+    samples = []
+    for i in range(iters):
+        kwargs = args_list[i % len(args_list)]
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            fn(**kwargs)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description="style/TPO retrieval latency benchmark")
+    parser.add_argument("--iters", type=int, default=30)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--category", default="상의")
+    parser.add_argument("--persona", default="pme", choices=list(PERSONA_MOOD.keys()))
+    args = parser.parse_args()
+
+    model = load_embedding_model()
+    db_cache = load_all_dbs(STYLE_DB_ROOT, TPO_DB_ROOT, [args.category])
+
+    # 캐시 비활성화: 매 요청이 실제 encode를 수행하도록
+    embedding_cache.max_size = 0
+    embedding_cache.clear()
+
+    negatives = {"fit": [], "pattern": [], "price_threshold": 500000}
+    args_list = [
+        dict(
+            persona=args.persona,
+            category=args.category,
+            style_query=safe_join(PERSONA_MOOD[args.persona]),
+            tpo_query=q,
+            db_cache=db_cache,
+            model=model,
+            negatives=negatives,
+            user_gender=GENDER_MAP[args.persona],
+            hard_constraints=init_hard_constraints(),
+            topk=5
+        )
+        for q in BENCH_TPO_QUERIES
+    ]
+
+    paths = {
+        "two-call": retrieve_candidates_by_category,
+        "batched": retrieve_candidates_by_category_batched,
+    }
+
+    print(f"\n👉 Benchmark: category={args.category}, persona={args.persona}, iters={args.iters}")
+    results = {}
+    for name, fn in paths.items():
+        run_path(fn, args_list, args.warmup)
+        results[name] = run_path(fn, args_list, args.iters)
+
+    print(f"\n{'path':<10} {'mean(ms)':>10} {'p50(ms)':>10} {'p99(ms)':>10}")
+    for name, samples in results.items():
+        print(
+            f"{name:<10} "
+            f"{np.mean(samples) * 1000:>10.1f} "
+            f"{percentile_ms(samples, 50):>10.1f} "
+            f"{percentile_ms(samples, 99):>10.1f}"
+        )
+
+    speedup = np.median(results["two-call"]) / np.median(results["batched"])
+    print(f"\n✅ batched p50 speedup: x{speedup:.2f}")
+
+
+if __name__ == "__main__":
+    main()
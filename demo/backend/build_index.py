@@ -0,0 +1,302 @@
+"""
+오프라인 FAISS DB 빌드 도구
+
+상품 카탈로그(JSONL / CSV)를 카테고리(main_cat_name)별로
+    ./faiss/style/<cat>/index.faiss + metadata.jsonl   (style 필드 임베딩)
+    ./faiss/tpo/<cat>/index.faiss   + metadata.jsonl   (tpo 필드 임베딩)
+로 만든다. 임베딩은 서버와 같은 load_embedding_model()로 큰 배치 단위 인코딩.
+
+카탈로그 전체를 메모리에 올리지 않는다.
+1) 카탈로그를 한 줄씩 읽어 카테고리별 임시 spool 파일(JSONL)로 나눠 씀
+2) 카테고리마다 spool에서 product_id → 파일 offset만 인덱싱 (같은 id는 마지막 줄 사용)
+3) --chunk-size개씩 읽어 임베딩 → 벡터는 인덱스에 추가, 메타데이터는 바로 임시 파일에 씀
+메모리 사용량은 카테고리 인덱스(벡터) 크기 + chunk 1개 + id / 해시 테이블 정도.
+
+--incremental 모드는 기존 DB를 유지한 채
+- 새 product_id → 임베딩 후 뒤에 추가
+- 임베딩 텍스트가 바뀐 product_id → 다시 임베딩해 같은 row에 교체
+- 텍스트가 같은 product_id → 임베딩 생략 (메타데이터만 갱신)
+한다. 텍스트 해시는 DB 폴더의 build_manifest.json에 저장된다.
+(manifest가 없는 기존 DB는 현재 벡터가 최신이라고 보고 해시만 기록)
+
+사용법:
+    python build_index.py --catalog products.jsonl
+    python build_index.py --catalog new_products.csv --incremental --batch-size 256 --chunk-size 8192
+"""
+import argparse
+import csv
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+import faiss
+import numpy as np
+
+from utils import *
+from bench_retrieval import STYLE_DB_ROOT, TPO_DB_ROOT
+
+MANIFEST_NAME = "build_manifest.json"
+
+# style DB는 상의 / 아우터 / 바지만 존재 (신발 / 가방은 tpo DB만)
+STYLE_CATEGORIES = ["상의", "아우터", "바지"]
+
+TEXT_CACHE_SIZE = 4096  # chunk 간 재사용할 임베딩 텍스트 수 (예: style 값은 카테고리당 몇 개뿐)
+
+
+# -------------------------------
+# Catalog
+# -------------------------------
+def iter_catalog(path):
+    """JSONL / CSV 카탈로그를 한 줄씩 읽기"""
+    if path.endswith(".csv"):
+        with open(path, encoding="utf-8-sig", newline="") as f:
+            for row in csv.DictReader(f):
+                record = {k: (v if v != "" else None) for k, v in row.items()}
+                if record.get("price_raw") is not None:
+                    record["price_raw"] = int(record["price_raw"])
+                yield record
+    else:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def spool_by_category(path, spool_dir):
+    """카탈로그를 카테고리별 spool 파일로 나눠 쓰기 → {cat: spool 경로}"""
+    files, spools = {}, {}
+    try:
+        for record in iter_catalog(path):
+            record["product_id"] = str(record["product_id"])
+            cat = record.get("main_cat_name")
+            if cat not in files:
+                spools[cat] = os.path.join(spool_dir, f"{len(spools)}.jsonl")
+                files[cat] = open(spools[cat], "w", encoding="utf-8")
+            files[cat].write(json.dumps(record, ensure_ascii=False) + "\n")
+    finally:
+        for f in files.values():
+            f.close()
+    return spools
+
+
+def index_spool(spool_path):
+    """
+    spool의 product_id → 마지막 줄의 byte offset
+    (dict 순서는 처음 등장한 순서 → 중복 id는 첫 위치 / 마지막 값)
+    """
+    offsets = {}
+    with open(spool_path, "rb") as f:
+        offset = f.tell()
+        for line in iter(f.readline, b""):
+            offsets[json.loads(line)["product_id"]] = offset
+            offset = f.tell()
+    return offsets
+
+
+def read_at(f, offset):
+    f.seek(offset)
+    return json.loads(f.readline())
+
+
+def embed_source(record, field):
+    value = record.get(field)
+    return safe_join(value) if isinstance(value, list) else (value or "")
+
+
+def text_hash(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+# -------------------------------
+# Embedding
+# -------------------------------
+def encode_batches(model, texts, batch_size):
+    vecs = []
+    for start in range(0, len(texts), batch_size):
+        with torch.no_grad():
+            v = model.encode(
+                texts[start:start + batch_size],
+                batch_size=batch_size,
+                convert_to_numpy=True,
+                normalize_embeddings=True
+            )
+        vecs.append(v.astype("float32"))
+    return np.concatenate(vecs) if vecs else None
+
+
+class ChunkWriter:
+    """
+    row를 chunk 단위로 모아 임베딩 → 인덱스에 벡터 추가 + metadata.jsonl에 기록
+    row: (record, 재사용할 벡터 or None, 임베딩 텍스트)
+    """
+    def __init__(self, index, meta_file, model, args):
+        self.index = index
+        self.meta_file = meta_file
+        self.model = model
+        self.args = args
+        self.rows = []
+        self.text_cache = {}
+        self.n_rows = 0
+        self.n_embedded = 0  # 새 벡터를 받은 row 수 (같은 텍스트 / 캐시 재사용 포함)
+        self.n_encoded = 0   # 실제로 모델에 넣은 텍스트 수
+
+    def add(self, record, vector, text):
+        self.rows.append((record, vector, text))
+        if len(self.rows) >= self.args.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        # 같은 텍스트(예: style 값)는 한 번만 인코딩
+        to_embed = list(dict.fromkeys(
+            text for _, vector, text in self.rows if vector is None and text not in self.text_cache
+        ))
+        encoded = dict(zip(to_embed, encode_batches(self.model, to_embed, self.args.batch_size))) if to_embed else {}
+        self.n_encoded += len(to_embed)
+
+        vectors = np.empty((len(self.rows), self.index.d), dtype="float32")
+        for i, (record, vector, text) in enumerate(self.rows):
+            if vector is None:
+                vector = encoded[text] if text in encoded else self.text_cache[text]
+                self.n_embedded += 1
+            vectors[i] = vector
+            self.meta_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.index.add(vectors)
+        self.n_rows += len(self.rows)
+        self.rows = []
+
+        if len(self.text_cache) + len(encoded) > TEXT_CACHE_SIZE:
+            self.text_cache.clear()
+        if len(encoded) <= TEXT_CACHE_SIZE:
+            self.text_cache.update(encoded)
+
+
+# -------------------------------
+# Build
+# -------------------------------
+def iter_existing(db_dir):
+    """기존 DB → (메타데이터, 벡터) row 스트림 / 없으면 빈 스트림"""
+    index_path = os.path.join(db_dir, index_file_name("flat"))
+    if not os.path.exists(index_path):
+        return
+    index = read_faiss_index(index_path)
+    with open(os.path.join(db_dir, "metadata.jsonl"), encoding="utf-8") as f:
+        for row, line in enumerate(l for l in f if l.strip()):
+            yield json.loads(line), index.reconstruct(row)
+
+
+def read_manifest(db_dir):
+    manifest_path = os.path.join(db_dir, MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def build_db(db_dir, spool_path, field, model, args):
+    """카테고리 DB 1개 빌드 → (전체 상품 수, 새 벡터를 받은 상품 수, 인코딩한 텍스트 수)"""
+    dim = model.get_sentence_embedding_dimension()
+    model_id = getattr(model, "model_id", EMBEDDING_MODEL_NAME)
+
+    hashes = {}
+    if args.incremental:
+        manifest = read_manifest(db_dir)
+        if manifest is not None and manifest.get("model") != model_id:
+            raise SystemExit(f"❌ {db_dir}: manifest model={manifest.get('model')} != {model_id} → 전체 빌드 필요")
+        hashes = dict(manifest["hashes"]) if manifest else {}
+
+    os.makedirs(db_dir, exist_ok=True)
+    index_path = os.path.join(db_dir, index_file_name("flat"))
+    meta_path = os.path.join(db_dir, "metadata.jsonl")
+    manifest_path = os.path.join(db_dir, MANIFEST_NAME)
+
+    offsets = index_spool(spool_path)
+    index = faiss.IndexFlatIP(dim)
+    with open(spool_path, encoding="utf-8") as spool, open(meta_path + ".tmp", "w", encoding="utf-8") as meta_file:
+        writer = ChunkWriter(index, meta_file, model, args)
+
+        # 1) 기존 row (incremental): 순서 유지, 카탈로그에 있으면 메타데이터 갱신 + 텍스트가 바뀐 경우만 재임베딩
+        if args.incremental:
+            for meta, vector in iter_existing(db_dir):
+                pid = str(meta["product_id"])
+                offset = offsets.pop(pid, None)
+                if offset is None:
+                    writer.add(meta, vector, None)
+                    continue
+                record = read_at(spool, offset)
+                text = embed_source(record, field)
+                h = text_hash(text)
+                # manifest 없는 기존 row는 현재 벡터를 최신으로 간주
+                writer.add(record, vector if hashes.get(pid, h) == h else None, text)
+                hashes[pid] = h
+
+        # 2) 새 product_id: 뒤에 추가
+        for pid, offset in offsets.items():
+            record = read_at(spool, offset)
+            text = embed_source(record, field)
+            writer.add(record, None, text)
+            hashes[pid] = text_hash(text)
+        writer.flush()
+
+    # index.faiss / metadata.jsonl / manifest를 임시 파일에 쓴 뒤 교체
+    faiss.write_index(index, index_path + ".tmp")
+    with open(manifest_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({"model": model_id, "field": field, "hashes": hashes}, f, ensure_ascii=False)
+
+    os.replace(index_path + ".tmp", index_path)
+    os.replace(meta_path + ".tmp", meta_path)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+    stale = [v for v in ("ivf", "hnsw", "sq8", "pq") if os.path.exists(os.path.join(db_dir, index_file_name(v)))]
+    if stale:
+        print(f"  ⚠️ {db_dir}: {', '.join(stale)} 인덱스는 이전 벡터 기준 → python ann_index.py build 로 다시 생성")
+    return writer.n_rows, writer.n_embedded, writer.n_encoded
+
+
+def main():
+    parser = argparse.ArgumentParser(description="build style / tpo FAISS DBs from a product catalog")
+    parser.add_argument("--catalog", required=True, help="JSONL or CSV product catalog")
+    parser.add_argument("--style-root", default=STYLE_DB_ROOT)
+    parser.add_argument("--tpo-root", default=TPO_DB_ROOT)
+    parser.add_argument("--style-field", default="style")
+    parser.add_argument("--tpo-field", default="tpo")
+    parser.add_argument("--style-categories", nargs="+", default=STYLE_CATEGORIES)
+    parser.add_argument("--batch-size", type=int, default=128)
+    parser.add_argument("--chunk-size", type=int, default=4096, help="products held in memory per embedding chunk")
+    parser.add_argument("--incremental", action="store_true", help="embed only new / changed products")
+    args = parser.parse_args()
+
+    model = load_embedding_model()
+
+    start = time.perf_counter()
+    n_encoded = 0
+    with tempfile.TemporaryDirectory(prefix="build_index_") as spool_dir:
+        spools = spool_by_category(args.catalog, spool_dir)
+        counts = {cat: len(index_spool(path)) for cat, path in spools.items()}
+        n_products = sum(counts.values())
+        print(f"👉 {n_products} products in {len(spools)} categories ({'incremental' if args.incremental else 'full'} build)")
+
+        for cat, spool_path in spools.items():
+            if cat is None:
+                print(f"  ⚠️ main_cat_name 없는 상품 {counts[cat]}개 건너뜀")
+                continue
+
+            targets = [("tpo", args.tpo_root, args.tpo_field)]
+            if cat in args.style_categories:
+                targets.append(("style", args.style_root, args.style_field))
+
+            for kind, root, field in targets:
+                db_start = time.perf_counter()
+                total, embedded, encoded = build_db(os.path.join(root, cat), spool_path, field, model, args)
+                n_encoded += encoded
+                print(f"  ✅ {kind}/{cat}: total={total}, embedded={embedded}, encoded={encoded}, skipped={counts[cat] - embedded} ({time.perf_counter() - db_start:.1f}s)")
+
+    elapsed = time.perf_counter() - start
+    print(f"\n✅ done in {elapsed:.1f}s: {n_products / elapsed:.1f} products/sec, {n_encoded} texts encoded")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,360 @@
+"""
+Retrieval 동등성 검증
+
+컬럼 스토어 / 역색인 비트셋 / 공용 상품 테이블로 바뀐 검색 경로가
+기존 per-row 필터(retrieve_from_faiss의 metas[idx] 루프)와 같은 결과를 내는지 확인한다.
+    1) filter   : 페르소나 × 성별 × negatives × 가격 기준 × hard constraints 조합
+                  + 세션 기본값(init_negatives)마다 기존 row 필터 == build_eligibility_bitset (모든 row)
+    2) retrieve : 같은 조합 + 쿼리 벡터마다 전체 인덱스를 스캔한 기존 필터 결과의 top-k
+                  == retrieve_from_faiss (selector / adaptive, 파티션 on / off)
+    3) snapshot : metadata.jsonl → metadata.colstore 저장 → mmap 로드 round-trip
+    4) products : build_product_table row → pid 매핑, pid_rows / exact 퓨전 벡터,
+                  pid_index 기반 lookup_item_by_id == product_id 문자열 비교 lookup
+기존 경로는 metadata.jsonl을 직접 읽어 재현하므로 컬럼 스토어와 독립적이다.
+쿼리는 임베딩 모델 없이 인덱스 벡터(+ 노이즈)로 만든다.
+top-k 비교는 exact 검색 기준이라 flat 인덱스(FAISS_INDEX_VARIANT=flat, 기본값)에서 실행한다.
+
+사용법:
+    python check_retrieval.py
+    python check_retrieval.py --category 상의 --queries 5 --topk 10
+"""
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import os
+import tempfile
+
+import numpy as np
+
+import utils
+from utils import *
+from bench_retrieval import STYLE_DB_ROOT, TPO_DB_ROOT
+from ann_index import CATEGORY_ORDER
+from metadata_store import MetadataStore, INT_FIELDS
+
+GENDERS = ["남자", "여자", None]
+PRICE_THRESHOLDS = [50000, 100000, 200000, 10 ** 9]
+NEGATIVE_SETS = [
+    {"fit": [], "pattern": []},
+    {"fit": ["오버사이즈"], "pattern": []},
+    {"fit": ["슬림"], "pattern": ["로고", "체크"]},
+    {"fit": ["오버사이즈", "슬림"], "pattern": ["스트라이프"]},
+]
+
+
+# -------------------------------
+# 기존 per-row 필터 (bitset pushdown 이전 retrieve_from_faiss)
+# -------------------------------
+def legacy_filter(meta, persona, user_gender, negatives, hard_constraints):
+    # gender filter
+    if user_gender == "남자" and meta.get("gender") == "여":
+        return False
+    if user_gender == "여자" and meta.get("gender") == "남":
+        return False
+
+    # persona filter
+    if persona == "pme" or persona == "promi":
+        if meta.get("style") == "스트릿":
+            return False
+
+    if hard_constraints["forced_sub_categories"]:
+        if meta.get("sub_cat_name") != hard_constraints["forced_sub_categories"][-1]:
+            return False
+    if hard_constraints["preferred_colors"]:
+        main_color = meta.get("color").split(", ")[0]
+        if not any(pref in main_color for pref in hard_constraints["preferred_colors"]):
+            return False
+    if hard_constraints["preferred_fits"]:
+        if meta.get("fit") != hard_constraints["preferred_fits"][-1]:
+            return False
+    if hard_constraints["preferred_patterns"]:
+        if meta.get("pattern") != hard_constraints["preferred_patterns"][-1]:
+            return False
+    if hard_constraints["preferred_textures"]:
+        if meta.get("texture") != hard_constraints["preferred_textures"][-1]:
+            return False
+
+    # negative filter
+    if meta.get("fit") in negatives["fit"]:
+        return False
+    if meta.get("pattern") in negatives["pattern"]:
+        return False
+    if meta.get("price_raw", 0) > negatives["price_threshold"]:
+        return False
+    return True
+
+
+def read_jsonl(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(l) for l in f if l.strip()]
+
+
+def normalize_record(record, fields):
+    """jsonl row → MetadataStore.row() 형태 (없는 필드는 None, 정수 컬럼 결측은 0)"""
+    row = {name: record.get(name) for name in fields}
+    for name in INT_FIELDS:
+        if name in row and row[name] is None:
+            row[name] = 0
+    return row
+
+
+def most_common(metas, field, n=2):
+    values = [m.get(field) for m in metas if m.get(field)]
+    return [v for v, _ in sorted(((v, values.count(v)) for v in set(values)), key=lambda x: (-x[1], x[0]))[:n]]
+
+
+def hard_constraint_sets(metas):
+    """카테고리 데이터에 실제로 있는 값으로 hard constraints 조합 생성"""
+    sets = [init_hard_constraints()]
+    for key, field in (
+        ("forced_sub_categories", "sub_cat_name"),
+        ("preferred_fits", "fit"),
+        ("preferred_patterns", "pattern"),
+        ("preferred_textures", "texture"),
+    ):
+        for value in most_common(metas, field):
+            hc = init_hard_constraints()
+            hc[key] = [value]
+            sets.append(hc)
+    for colors in (["블랙"], ["화이트", "크림", "아이보리"], ["카키", "그린"]):
+        hc = init_hard_constraints()
+        hc["preferred_colors"] = colors
+        sets.append(hc)
+    hc = init_hard_constraints()
+    hc["preferred_colors"] = ["블랙"]
+    hc["forced_sub_categories"] = most_common(metas, "sub_cat_name", 1)
+    sets.append(hc)
+    return sets
+
+
+def filter_grid(metas):
+    for persona, user_gender, negatives, threshold, hc in itertools.product(
+        PERSONA_MOOD, GENDERS, NEGATIVE_SETS, PRICE_THRESHOLDS, hard_constraint_sets(metas)
+    ):
+        yield persona, user_gender, dict(negatives, price_threshold=threshold), hc
+    # 세션 기본값 그대로 (/session/negatives, /feedback 호출 전)
+    for persona in PERSONA_MOOD:
+        yield persona, GENDER_MAP[persona], init_negatives(), init_hard_constraints()
+
+
+# -------------------------------
+# Checks
+# -------------------------------
+class Report:
+    def __init__(self):
+        self.counts = {}
+        self.failures = []
+
+    def check(self, section, ok, detail):
+        passed, total = self.counts.get(section, (0, 0))
+        self.counts[section] = (passed + bool(ok), total + 1)
+        if not ok and len(self.failures) < 20:
+            self.failures.append(f"[{section}] {detail}")
+
+
+def check_filters(report, kind, cat, db, metas):
+    """조합마다 기존 필터 결과(row 마스크)를 반환 → retrieve 비교에 재사용"""
+    grid = []
+    for persona, user_gender, negatives, hc in filter_grid(metas):
+        expected = np.array([legacy_filter(m, persona, user_gender, negatives, hc) for m in metas])
+        grid.append((persona, user_gender, negatives, hc, expected))
+        bits = build_eligibility_bitset(db["attr_index"], persona, user_gender, negatives, hc)
+        bits = utils._row_bitset(db["attr_index"], bits, db["rows"])
+        got = np.unpackbits(bits, count=len(metas), bitorder="little").astype(bool)
+        diff = np.flatnonzero(expected != got)
+        report.check(
+            "filter", len(diff) == 0,
+            f"{kind}/{cat} persona={persona} gender={user_gender} negatives={negatives} hc={hc}: rows {diff[:5].tolist()}"
+        )
+
+    # price_threshold 키가 없는 negatives → 기본 가격 상한 적용
+    for persona in PERSONA_MOOD:
+        user_gender, hc = GENDER_MAP[persona], init_hard_constraints()
+        expected = np.array([legacy_filter(m, persona, user_gender, init_negatives(), hc) for m in metas])
+        bits = build_eligibility_bitset(db["attr_index"], persona, user_gender, {"fit": [], "pattern": []}, hc)
+        got = np.unpackbits(utils._row_bitset(db["attr_index"], bits, db["rows"]), count=len(metas), bitorder="little").astype(bool)
+        report.check("filter", np.array_equal(expected, got), f"{kind}/{cat} persona={persona}: default price cap not applied")
+    return grid
+
+
+def same_ranking(expected, got):
+    """product_id 순서 비교 (점수가 같은 아이템끼리는 순서 무관)"""
+    if len(expected) != len(got):
+        return False
+    e_scores = np.array([s for _, s in expected])
+    g_scores = np.array([s for _, s in got])
+    if not np.allclose(e_scores, g_scores, atol=1e-5):
+        return False
+    groups = np.round(e_scores, 5)
+    for score in set(groups.tolist()):
+        e_ids = {pid for (pid, _), g in zip(expected, groups) if g == score}
+        g_ids = {pid for (pid, _), g in zip(got, groups) if g == score}
+        # 동점 그룹이 top-k 경계에 걸리면 어느 아이템이 들어갈지는 구현마다 다를 수 있음
+        if e_ids != g_ids and score != groups[-1]:
+            return False
+    return True
+
+
+def check_retrieval(report, kind, cat, db, metas, grid, queries, topk, depth_stats):
+    xb = db["vectors"].reconstruct_n(0, db["index"].ntotal)
+    for q in queries:
+        scores = xb @ q
+        order = np.argsort(-scores, kind="stable")
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order))
+        for persona, user_gender, negatives, hc, eligible in grid:
+            passed = order[eligible[order]]
+            expected = [(str(metas[i]["product_id"]), float(scores[i])) for i in passed[:topk]]
+
+            # 기존 경로는 topk * 30개만 검색 후 필터 → 필터가 강하면 결과가 부족했음 (정보용)
+            if (rank[passed[:topk]] >= topk * 30).any():
+                depth_stats[0] += 1
+            depth_stats[1] += 1
+
+            for mode, partitioned in itertools.product(("selector", "adaptive"), (False, True)):
+                utils.FAISS_SEARCH_MODE = mode
+                with contextlib.redirect_stdout(io.StringIO()):
+                    items = retrieve_from_faiss(
+                        persona, None, db["index"], db["meta"], None, negatives, user_gender, hc,
+                        topk=topk, query_vec=q, attr_index=db["attr_index"], rows=db["rows"],
+                        partitions=db["partitions_on"] if partitioned else None
+                    )
+                got = [(str(item["product_id"]), item["score"]) for item in items]
+                report.check(
+                    "retrieve", same_ranking(expected, got),
+                    f"{kind}/{cat} mode={mode} partitions={partitioned} persona={persona} gender={user_gender} "
+                    f"negatives={negatives} hc={hc}: expected {expected} got {got}"
+                )
+    utils.FAISS_SEARCH_MODE = FAISS_SEARCH_MODE
+
+
+def check_snapshot(report, kind, cat, db_dir, metas):
+    store = MetadataStore.from_jsonl(os.path.join(db_dir, "metadata.jsonl"))
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "metadata.colstore")
+        store.write_snapshot(path)
+        loaded = MetadataStore.open_snapshot(path)
+        for name, store_ in (("round-trip", loaded), ("on-disk", load_metadata(db_dir))):
+            ok = (
+                len(store_) == len(metas)
+                and store_.fields == store.fields
+                and store_.vocabs == store.vocabs
+                and all(store_.row(i) == normalize_record(m, store.fields) for i, m in enumerate(metas))
+                and np.array_equal(np.asarray(store_.columns["main_color"]), store.columns["main_color"])
+            )
+            report.check("snapshot", ok, f"{kind}/{cat} {name}: colstore rows differ from metadata.jsonl")
+        del loaded
+
+
+def check_products(report, cat, db_cache, raw):
+    products = db_cache["products"][cat]
+    table, pid_index = products["meta"], products["pid_index"]
+
+    # pid는 처음 등장한 row(tpo → style 순서)의 속성을 가짐
+    first = {}
+    for kind in ("tpo", "style"):
+        for m in raw.get(kind, []):
+            first.setdefault(str(m["product_id"]), m)
+    report.check("products", len(table) == len(first) == len(pid_index), f"{cat}: table size {len(table)} != products {len(first)}")
+    for product_id, m in first.items():
+        pid = pid_index.get(product_id)
+        ok = pid is not None and table.row(pid) == normalize_record(m, table.fields)
+        report.check("products", ok, f"{cat}: pid_index[{product_id}] row differs from first metadata row")
+
+    for kind, metas in raw.items():
+        db = db_cache[kind][cat]
+        rows = np.arange(len(metas)) if db["rows"] is None else db["rows"]
+        xb = db["vectors"].reconstruct_n(0, db["index"].ntotal)
+        for r, m in enumerate(metas):
+            pid = int(rows[r])
+            ok = str(table.value("product_id", pid)) == str(m["product_id"]) and pid_index[str(m["product_id"])] == pid
+            report.check("products", ok, f"{kind}/{cat}: row {r} → pid {pid} is not product_id {m['product_id']}")
+            # pid_rows / vectors (exact 퓨전): 같은 상품의 row 벡터 (중복 row는 마지막 row)
+            row = db["pid_rows"][pid]
+            ok = row >= 0 and str(metas[row]["product_id"]) == str(m["product_id"])
+            report.check("products", ok, f"{kind}/{cat}: pid_rows[{pid}]={row} for product_id {m['product_id']}")
+        # 인덱스에 없는 상품은 -1 → exact 유사도 0
+        missing = np.flatnonzero(db["pid_rows"] < 0)
+        in_index = {str(m["product_id"]) for m in metas}
+        report.check(
+            "products", all(str(table.value("product_id", p)) not in in_index for p in missing),
+            f"{kind}/{cat}: pid_rows marks indexed products as missing"
+        )
+        q = xb[0]
+        sims = utils._exact_sims(db, np.arange(len(table)), q)
+        expected = np.where(db["pid_rows"] >= 0, xb[np.maximum(db["pid_rows"], 0)] @ q, 0.0)
+        report.check("products", np.allclose(sims, expected, atol=1e-5), f"{kind}/{cat}: _exact_sims differs from row vectors")
+
+        # lookup_item_by_id: pid 비교 == product_id 문자열 비교
+        candidates = []
+        for r in range(len(metas)):
+            item = table.row(int(rows[r]))
+            item["pid"] = int(rows[r])
+            candidates.append(item)
+        with contextlib.redirect_stdout(io.StringIO()):
+            for product_id in list(first) + ["__missing__"]:
+                a = lookup_item_by_id(product_id, candidates, pid_index)
+                b = lookup_item_by_id(product_id, candidates)
+                report.check("lookup", a is b, f"{kind}/{cat}: lookup_item_by_id({product_id}) pid={a and a['pid']} str={b and b['pid']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="check bitset / colstore / product table retrieval against the legacy per-row path")
+    parser.add_argument("--style-root", default=STYLE_DB_ROOT)
+    parser.add_argument("--tpo-root", default=TPO_DB_ROOT)
+    parser.add_argument("--category", nargs="+", default=CATEGORY_ORDER)
+    parser.add_argument("--queries", type=int, default=3, help="query vectors per index")
+    parser.add_argument("--topk", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if FAISS_INDEX_VARIANT != "flat":
+        raise SystemExit(f"❌ FAISS_INDEX_VARIANT={FAISS_INDEX_VARIANT}: top-k 비교는 flat 인덱스에서만 의미가 있음")
+
+    rng = np.random.default_rng(args.seed)
+    with contextlib.redirect_stdout(io.StringIO()):
+        db_cache = load_all_dbs(args.style_root, args.tpo_root, args.category)
+
+    report = Report()
+    depth_stats = [0, 0]
+    for cat in args.category:
+        raw = {}
+        for kind, root in (("tpo", args.tpo_root), ("style", args.style_root)):
+            db = db_cache[kind][cat]
+            if db is None:
+                continue
+            db_dir = os.path.join(root, cat)
+            metas = read_jsonl(os.path.join(db_dir, "metadata.jsonl"))
+            raw[kind] = metas
+
+            utils.FAISS_PARTITIONS = True
+            db["partitions_on"] = build_partitions(db["index"], db["attr_index"], db["rows"])
+            utils.FAISS_PARTITIONS = FAISS_PARTITIONS
+
+            xb = db["vectors"].reconstruct_n(0, db["index"].ntotal)
+            queries = xb[rng.choice(len(xb), args.queries, replace=False)]
+            queries = queries + rng.normal(scale=0.02, size=queries.shape).astype("float32")
+            queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+            grid = check_filters(report, kind, cat, db, metas)
+            check_retrieval(report, kind, cat, db, metas, grid, queries, args.topk, depth_stats)
+            check_snapshot(report, kind, cat, db_dir, metas)
+            print(f"  ✅ {kind}/{cat}: {len(metas)} rows checked")
+        check_products(report, cat, db_cache, raw)
+
+    print(f"\n=== RETRIEVAL EQUIVALENCE ({', '.join(args.category)}) ===")
+    for section, (passed, total) in report.counts.items():
+        print(f"{section:<10} {passed:>8} / {total:<8} {'✅' if passed == total else '❌'}")
+    print(f"legacy topk*30 depth would have dropped results in {depth_stats[0]} / {depth_stats[1]} filter × query cases")
+
+    if report.failures:
+        print("\n❌ mismatches:")
+        for f in report.failures:
+            print(f"  {f}")
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""
+TPO 분석 모드 비교 (pipeline vs combined)
+
+fixture(페르소나 + TPO 문장)마다
+    - pipeline: refine_tpo_text + parse_tpo 동시 호출 → judge_conflict  (3회 호출)
+    - combined: analyze_tpo structured output 1회 호출
+를 실행해 두 모드의 일치도와 지연시간을 출력한다.
+    - conflict 일치율
+    - refined_tpo: 완전 일치율 / 임베딩 cosine 평균
+    - parsed_keywords: 키워드 집합 Jaccard 평균 / 검색 쿼리(safe_join) 임베딩 cosine 평균
+기본은 LLM 캐시를 끄고 실제 호출 지연시간을 측정한다 (--use-cache로 재사용).
+
+사용법:
+    python compare_tpo_analysis.py --fixtures tpo_fixtures.jsonl
+    python compare_tpo_analysis.py --out tpo_compare.jsonl --use-cache
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import time
+
+import numpy as np
+
+from utils import *
+
+
+def load_fixtures(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(l) for l in f if l.strip()]
+
+
+async def run_pipeline(persona, tpo):
+    refined, parsed = await asyncio.gather(refine_tpo_text_async(tpo), parse_tpo_async(tpo))
+    conflict = await judge_conflict_async(persona, parsed)
+    return {"refined_tpo": refined, "parsed_keywords": parsed, "conflict": conflict}
+
+
+async def run_combined(persona, tpo):
+    return await analyze_tpo_async(persona, tpo)
+
+
+async def run_fixture(fixture):
+    out = {}
+    for mode, fn in (("pipeline", run_pipeline), ("combined", run_combined)):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            out[mode] = await fn(fixture["persona"], fixture["tpo"])
+        out[mode]["seconds"] = time.perf_counter() - start
+    return out
+
+
+def normalize_keyword(k):
+    return " ".join(k.split())
+
+
+def jaccard(a, b):
+    a, b = {normalize_keyword(k) for k in a}, {normalize_keyword(k) for k in b}
+    return len(a & b) / len(a | b) if a | b else 1.0
+
+
+def pair_cosine(model, texts_a, texts_b):
+    va, vb = embed_texts(texts_a, model), embed_texts(texts_b, model)
+    return np.sum(va * vb, axis=1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="compare pipeline vs combined TPO analysis")
+    parser.add_argument("--fixtures", default="tpo_fixtures.jsonl")
+    parser.add_argument("--out", default=None, help="write per-fixture results as JSONL")
+    parser.add_argument("--use-cache", action="store_true", help="reuse the LLM response cache")
+    args = parser.parse_args()
+
+    if not args.use_cache:
+        llm_cache.enabled = False
+
+    fixtures = load_fixtures(args.fixtures)
+    print(f"👉 {len(fixtures)} fixtures, LLM cache {'on' if llm_cache.enabled else 'off'}")
+
+    async def run_all():
+        return [await run_fixture(f) for f in fixtures]
+
+    results = asyncio.run(run_all())
+    pipe = [r["pipeline"] for r in results]
+    comb = [r["combined"] for r in results]
+
+    model = load_embedding_model()
+    refined_cos = pair_cosine(model, [p["refined_tpo"] for p in pipe], [c["refined_tpo"] for c in comb])
+    query_cos = pair_cosine(
+        model,
+        [safe_join(p["parsed_keywords"]) for p in pipe],
+        [safe_join(c["parsed_keywords"]) for c in comb]
+    )
+    conflict_agree = [p["conflict"] == c["conflict"] for p, c in zip(pipe, comb)]
+    refined_exact = [p["refined_tpo"] == c["refined_tpo"] for p, c in zip(pipe, comb)]
+    keyword_jaccard = [jaccard(p["parsed_keywords"], c["parsed_keywords"]) for p, c in zip(pipe, comb)]
+
+    print(f"\n=== TPO ANALYSIS: pipeline vs combined (n={len(fixtures)}) ===")
+    print(f"conflict agreement      : {np.mean(conflict_agree):.3f}")
+    print(f"refined_tpo exact match : {np.mean(refined_exact):.3f}")
+    print(f"refined_tpo cosine      : {np.mean(refined_cos):.3f}")
+    print(f"parsed_keywords jaccard : {np.mean(keyword_jaccard):.3f}")
+    print(f"tpo query cosine        : {np.mean(query_cos):.3f}")
+
+    print(f"\n{'mode':<10} {'calls':>6} {'p50(ms)':>10} {'p95(ms)':>10}")
+    for mode, rows, calls in (("pipeline", pipe, 3), ("combined", comb, 1)):
+        seconds = [r["seconds"] for r in rows]
+        print(f"{mode:<10} {calls:>6} {np.percentile(seconds, 50) * 1000:>10.1f} {np.percentile(seconds, 95) * 1000:>10.1f}")
+
+    disagreements = [
+        (f, p, c) for f, p, c, agree in zip(fixtures, pipe, comb, conflict_agree) if not agree
+    ]
+    if disagreements:
+        print("\n⚠️ conflict 불일치:")
+        for f, p, c in disagreements:
+            print(f"  [{f['persona']}] {f['tpo']} → pipeline={p['conflict']}, combined={c['conflict']}")
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            for fixture, r, rc, qc in zip(fixtures, results, refined_cos, query_cos):
+                row = dict(fixture, **r, refined_cosine=float(rc), query_cosine=float(qc))
+                f.write(json.dumps(row, ensure_ascii=False) + "\n")
+        print(f"\n✅ per-fixture results → {args.out}")
+
+
+if __name__ == "__main__":
+    main()
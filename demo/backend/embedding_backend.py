@@ -0,0 +1,145 @@
+"""
+임베딩 백엔드 export / parity check 도구
+
+EMBEDDING_BACKEND=onnx / onnx-int8 로 서버를 띄우기 전에
+1) export : upskyy/bge-m3-korean 을 ONNX 그래프로 내보내고 int8 동적 양자화 버전을 생성
+2) parity : torch 백엔드 대비 코사인 일치도와 FAISS top-k 검색 결과 겹침 비율,
+            encode p50 지연시간, 상주 메모리(RSS)를 비교
+
+사용법:
+    pip install "optimum[onnxruntime]"
+    python embedding_backend.py export --out ./onnx_model --quant-config avx512_vnni
+    python embedding_backend.py parity --backend onnx-int8 --topk 10
+"""
+import argparse
+import contextlib
+import io
+import sys
+import time
+
+import numpy as np
+
+from utils import *
+from bench_retrieval import BENCH_TPO_QUERIES, STYLE_DB_ROOT, TPO_DB_ROOT
+
+CATEGORY_ORDER = ["상의", "아우터", "바지", "신발", "가방"]
+
+
+def rss_mb():
+    """현재 프로세스 상주 메모리 (MB)"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def export(args):
+    from sentence_transformers import SentenceTransformer, export_dynamic_quantized_onnx_model
+
+    print(f"👉 Exporting {EMBEDDING_MODEL_NAME} to ONNX...")
+    model = SentenceTransformer(EMBEDDING_MODEL_NAME, device="cpu", backend="onnx")
+    model.save_pretrained(args.out)
+    print(f"  ✅ ONNX 저장: {args.out}/onnx/model.onnx")
+
+    print(f"👉 Quantizing (int8, dynamic, {args.quant_config})...")
+    export_dynamic_quantized_onnx_model(model, args.quant_config, args.out)
+    print(f"  ✅ int8 저장: {args.out}/onnx/model_qint8_{args.quant_config}.onnx")
+
+
+def encode_queries(model, queries):
+    """온라인 경로와 동일하게 쿼리 1개씩 인코딩 → (벡터, 지연시간 리스트)"""
+    vecs, latencies = [], []
+    for q in queries:
+        start = time.perf_counter()
+        with torch.no_grad():
+            v = model.encode(q, convert_to_numpy=True, normalize_embeddings=True)
+        latencies.append(time.perf_counter() - start)
+        vecs.append(v.astype("float32"))
+    return np.stack(vecs), latencies
+
+
+def topk_overlap(index, ref_vecs, cand_vecs, topk):
+    k = min(topk, index.ntotal)
+    _, ref_ids = index.search(ref_vecs, k)
+    _, cand_ids = index.search(cand_vecs, k)
+    return [
+        len(set(r) & set(c)) / k
+        for r, c in zip(ref_ids.tolist(), cand_ids.tolist())
+    ]
+
+
+def parity(args):
+    queries = [safe_join(PERSONA_MOOD[p]) for p in PERSONA_MOOD] + BENCH_TPO_QUERIES
+
+    rss_before = rss_mb()
+    ref_model = load_embedding_model("torch")
+    rss_torch = rss_mb() - rss_before
+
+    rss_before = rss_mb()
+    cand_model = load_embedding_model(args.backend)
+    rss_cand = rss_mb() - rss_before
+
+    # warmup
+    encode_queries(ref_model, queries[:2])
+    encode_queries(cand_model, queries[:2])
+
+    ref_vecs, ref_lat = encode_queries(ref_model, queries)
+    cand_vecs, cand_lat = encode_queries(cand_model, queries)
+    cosines = np.sum(ref_vecs * cand_vecs, axis=1)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        db_cache = load_all_dbs(STYLE_DB_ROOT, TPO_DB_ROOT, CATEGORY_ORDER)
+
+    print(f"\n=== PARITY: torch vs {args.backend} (n_queries={len(queries)}, top{args.topk}) ===")
+    print(f"cosine   mean={cosines.mean():.4f}  min={cosines.min():.4f}")
+
+    overlaps = []
+    for kind in ("style", "tpo"):
+        for cat in CATEGORY_ORDER:
+            db = db_cache[kind][cat]
+            if db is None:
+                continue
+            ov = topk_overlap(db["index"], ref_vecs, cand_vecs, args.topk)
+            overlaps.extend(ov)
+            print(f"overlap  {kind}/{cat}: mean={np.mean(ov):.3f}  min={np.min(ov):.3f}")
+
+    print(f"encode p50  torch={np.percentile(ref_lat, 50) * 1000:.1f}ms  {args.backend}={np.percentile(cand_lat, 50) * 1000:.1f}ms")
+    print(f"RSS delta   torch={rss_torch:.0f}MB  {args.backend}={rss_cand:.0f}MB")
+
+    ok = cosines.min() >= args.min_cosine and np.mean(overlaps) >= args.min_overlap
+    if ok:
+        print("\n✅ parity check passed")
+    else:
+        print(f"\n❌ parity check failed (min_cosine={args.min_cosine}, min_overlap={args.min_overlap})")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="embedding backend export / parity check")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_export = sub.add_parser("export", help="ONNX export + int8 dynamic quantization")
+    p_export.add_argument("--out", default=ONNX_MODEL_DIR)
+    p_export.add_argument("--quant-config", default=ONNX_QUANT_CONFIG,
+                          choices=["arm64", "avx2", "avx512", "avx512_vnni"])
+
+    p_parity = sub.add_parser("parity", help="compare a backend against torch")
+    p_parity.add_argument("--backend", default="onnx-int8", choices=["onnx", "onnx-int8"])
+    p_parity.add_argument("--topk", type=int, default=10)
+    p_parity.add_argument("--min-cosine", type=float, default=0.99)
+    p_parity.add_argument("--min-overlap", type=float, default=0.9)
+
+    args = parser.parse_args()
+    if args.command == "export":
+        export(args)
+    elif not parity(args):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+"""
+세션 간 임베딩 micro-batching 서비스
+
+여러 키오스크 세션이 동시에 /recommend/next를 호출하면 각 요청이
+batch size 1로 SentenceTransformer.encode를 실행한다.
+EmbeddingService는 전역 모델을 감싸서 짧은 window(수 ms) 동안 들어온
+encode 요청을 모아 한 번의 배치로 실행하고, 각 호출자의 Future를 resolve한다.
+
+model.encode와 같은 인터페이스를 제공하므로 embed_text / embed_texts에
+모델 대신 그대로 넘길 수 있다.
+"""
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+import torch
+
+from metrics import Histogram
+
+EMBED_MICRO_BATCHING = os.getenv("EMBED_MICRO_BATCHING", "1") == "1"
+EMBED_BATCH_WINDOW_MS = float(os.getenv("EMBED_BATCH_WINDOW_MS", "5"))
+EMBED_MAX_BATCH_SIZE = int(os.getenv("EMBED_MAX_BATCH_SIZE", "32"))
+
+
+class _EncodeRequest:
+    __slots__ = ("text", "normalize", "future")
+
+    def __init__(self, text, normalize):
+        self.text = text
+        self.normalize = normalize
+        self.future = Future()
+
+
+class EmbeddingService:
+    def __init__(self, model, window_ms: float = EMBED_BATCH_WINDOW_MS, max_batch_size: int = EMBED_MAX_BATCH_SIZE):
+        self.model = model
+        self.window = window_ms / 1000.0
+        self.max_batch_size = max_batch_size
+
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self.queue_depth_hist = Histogram([0, 1, 2, 4, 8, 16, 32, 64])
+        self.batch_size_hist = Histogram([1, 2, 4, 8, 16, 32, 64])
+        self.batches = 0
+        self.requests = 0
+
+        self._worker = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+        self._worker.start()
+
+    @property
+    def model_id(self):
+        # 임베딩 캐시 key는 감싼 모델 기준
+        return getattr(self.model, "model_id", None)
+
+    # -------------------------------
+    # Public API
+    # -------------------------------
+    def submit(self, text: str, normalize: bool = True) -> Future:
+        """단일 문장 encode 요청을 큐에 넣고 Future 반환"""
+        if self._stopped.is_set():
+            raise RuntimeError("EmbeddingService is stopped")
+        req = _EncodeRequest(text, normalize)
+        with self._lock:
+            self.requests += 1
+        self._queue.put(req)
+        return req.future
+
+    def encode(self, sentences, convert_to_numpy=True, normalize_embeddings=True, **kwargs):
+        """SentenceTransformer.encode 호환: str이면 (dim,), list면 (n, dim)"""
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        futures = [self.submit(t, normalize_embeddings) for t in texts]
+        vecs = np.stack([f.result() for f in futures])
+        return vecs[0] if single else vecs
+
+    def stop(self):
+        self._stopped.set()
+        self._queue.put(None)
+        self._worker.join(timeout=5)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "window_ms": self.window * 1000,
+                "max_batch_size": self.max_batch_size,
+                "pending": self._queue.qsize(),
+                "requests": self.requests,
+                "batches": self.batches,
+                "queue_depth": self.queue_depth_hist.snapshot(),
+                "batch_size": self.batch_size_hist.snapshot()
+            }
+
+    # -------------------------------
+    # Worker
+    # -------------------------------
+    def _collect_batch(self, first):
+        """첫 요청 이후 window 동안 또는 max_batch_size까지 요청을 모음"""
+        batch = [first]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                req = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if req is None:
+                self._stopped.set()
+                break
+            batch.append(req)
+        return batch
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                first = self._queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if first is None:
+                break
+
+            batch = self._collect_batch(first)
+            with self._lock:
+                self.batches += 1
+                self.batch_size_hist.observe(len(batch))
+                # 배치를 닫는 시점에 아직 큐에 남아 있는 요청 수 (backlog)
+                self.queue_depth_hist.observe(self._queue.qsize())
+            self._process(batch)
+
+        # 종료 시 남은 요청은 실패 처리
+        while True:
+            try:
+                req = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if req is not None and req.future.set_running_or_notify_cancel():
+                req.future.set_exception(RuntimeError("EmbeddingService is stopped"))
+
+    def _process(self, batch):
+        batch = [r for r in batch if r.future.set_running_or_notify_cancel()]
+        # normalize 옵션별로 나눠서 encode (일반적으로 한 그룹)
+        for normalize in (True, False):
+            group = [r for r in batch if r.normalize == normalize]
+            if not group:
+                continue
+            try:
+                with torch.no_grad():
+                    vecs = self.model.encode(
+                        [r.text for r in group],
+                        batch_size=len(group),
+                        convert_to_numpy=True,
+                        normalize_embeddings=normalize
+                    )
+                vecs = np.asarray(vecs, dtype="float32")
+                for r, v in zip(group, vecs):
+                    r.future.set_result(v)
+            except Exception as e:
+                for r in group:
+                    r.future.set_exception(e)
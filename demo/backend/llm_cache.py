@@ -0,0 +1,203 @@
+"""
+OpenAI chat completion 응답 캐시 (SQLite, 로컬 디스크)
+
+같은 TPO 문장 / 같은 후보 조합에 대한 LLM 호출 결과를 재사용한다.
+- key: 호출 지점(site) + 모델 + 프롬프트 버전(system 프롬프트 해시) + 요청(messages, 파라미터) 해시
+- 호출 지점별 TTL (LLM_CACHE_TTL_<SITE> 환경변수로 초 단위 변경)
+- 최대 엔트리 수를 넘으면 가장 오래 사용하지 않은 엔트리부터 삭제
+- 호출 지점별 hit / miss / 소요 시간 통계
+
+WAL 모드라 여러 uvicorn 워커가 같은 파일을 공유해도 된다.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE", "1") == "1"
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "./llm_cache.sqlite3")
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "20000"))
+LLM_CACHE_VERSION = os.getenv("LLM_CACHE_VERSION", "1")  # 올리면 전체 캐시 무효화
+
+DAY = 24 * 60 * 60
+
+# 호출 지점별 기본 TTL (초)
+DEFAULT_TTLS = {
+    "refine_tpo": 30 * DAY,
+    "parse_tpo": 30 * DAY,
+    "judge_conflict": 30 * DAY,
+    "analyze_tpo": 30 * DAY,
+    "rerank": 1 * DAY,
+    "rerank_explain": 1 * DAY,
+    "generate_reason": 7 * DAY,
+    "update_query": 7 * DAY,
+}
+FALLBACK_TTL = 1 * DAY
+
+
+def _canonical(obj):
+    return json.dumps(obj, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+
+
+def _sha256(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class LLMCache:
+    def __init__(self, path=LLM_CACHE_PATH, max_entries=LLM_CACHE_MAX_ENTRIES, enabled=LLM_CACHE_ENABLED):
+        self.path = path
+        self.max_entries = max_entries
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._conn = None
+        self._puts_since_evict = 0
+        self._stats = {}  # site -> {"hits", "misses", "hit_seconds", "miss_seconds", "fallbacks"}
+
+    # -------------------------------
+    # Storage
+    # -------------------------------
+    def _connect(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=5.0)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS llm_cache (
+                    key TEXT PRIMARY KEY,
+                    site TEXT NOT NULL,
+                    response TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    expires_at REAL NOT NULL,
+                    last_access REAL NOT NULL
+                )
+                """
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_access ON llm_cache(last_access)")
+        return self._conn
+
+    @staticmethod
+    def ttl_for(site):
+        env = os.getenv(f"LLM_CACHE_TTL_{site.upper()}")
+        return float(env) if env else DEFAULT_TTLS.get(site, FALLBACK_TTL)
+
+    @staticmethod
+    def make_key(site, request):
+        """
+        request: chat.completions.create에 넘기는 kwargs (model, messages, temperature, ...)
+        프롬프트 버전 = system 프롬프트 해시 → 프롬프트를 수정하면 자동으로 새 key
+        """
+        messages = request.get("messages", [])
+        system = "".join(m["content"] for m in messages if m.get("role") == "system")
+        prompt_version = f"{LLM_CACHE_VERSION}:{_sha256(system)[:12]}"
+        return _sha256(_canonical([site, request.get("model"), prompt_version, request]))
+
+    # -------------------------------
+    # Get / Put
+    # -------------------------------
+    def get(self, site, key):
+        if not self.enabled:
+            return None
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute(
+                "SELECT response, expires_at FROM llm_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if row[1] < now:
+                conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                conn.commit()
+                return None
+            conn.execute("UPDATE llm_cache SET last_access = ? WHERE key = ?", (now, key))
+            conn.commit()
+            return row[0]
+
+    def put(self, site, key, response):
+        if not self.enabled or response is None:
+            return
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, site, response, created_at, expires_at, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, site, response, now, now + self.ttl_for(site), now)
+            )
+            self._puts_since_evict += 1
+            # 매 put마다 COUNT하지 않고 일정 간격으로 정리
+            if self._puts_since_evict >= 100:
+                self._evict(conn, now)
+            conn.commit()
+
+    def _evict(self, conn, now):
+        self._puts_since_evict = 0
+        conn.execute("DELETE FROM llm_cache WHERE expires_at < ?", (now,))
+        (count,) = conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()
+        overflow = count - self.max_entries
+        if overflow > 0:
+            conn.execute(
+                "DELETE FROM llm_cache WHERE key IN "
+                "(SELECT key FROM llm_cache ORDER BY last_access ASC LIMIT ?)",
+                (overflow,)
+            )
+
+    def clear(self):
+        with self._lock:
+            conn = self._connect()
+            conn.execute("DELETE FROM llm_cache")
+            conn.commit()
+
+    # -------------------------------
+    # Metrics
+    # -------------------------------
+    def _site_stats(self, site):
+        return self._stats.setdefault(
+            site, {"hits": 0, "misses": 0, "hit_seconds": 0.0, "miss_seconds": 0.0, "fallbacks": 0}
+        )
+
+    def record(self, site, hit, seconds):
+        with self._lock:
+            s = self._site_stats(site)
+            if hit:
+                s["hits"] += 1
+                s["hit_seconds"] += seconds
+            else:
+                s["misses"] += 1
+                s["miss_seconds"] += seconds
+
+    def record_fallback(self, site):
+        """LLM 응답 대신 기본값을 사용한 횟수 (실패 / timeout)"""
+        with self._lock:
+            self._site_stats(site)["fallbacks"] += 1
+
+    def stats(self):
+        with self._lock:
+            sites = {}
+            for site, s in self._stats.items():
+                total = s["hits"] + s["misses"]
+                sites[site] = {
+                    "hits": s["hits"],
+                    "misses": s["misses"],
+                    "hit_rate": s["hits"] / total if total else 0.0,
+                    "avg_hit_ms": s["hit_seconds"] / s["hits"] * 1000 if s["hits"] else None,
+                    "avg_miss_ms": s["miss_seconds"] / s["misses"] * 1000 if s["misses"] else None,
+                    "fallbacks": s["fallbacks"],
+                    "ttl_seconds": self.ttl_for(site)
+                }
+            entries = None
+            if self.enabled:
+                (entries,) = self._connect().execute("SELECT COUNT(*) FROM llm_cache").fetchone()
+            return {
+                "enabled": self.enabled,
+                "path": self.path,
+                "entries": entries,
+                "max_entries": self.max_entries,
+                "sites": sites
+            }
+
+
+llm_cache = LLMCache()
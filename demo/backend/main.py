@@ -1,4 +1,5 @@
 from fastapi import FastAPI, HTTPException, Header, Response
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 import requests
 from urllib.parse import unquote
@@ -12,11 +13,17 @@ import torch
 import qrcode
 from io import BytesIO
 import base64
+import asyncio
+import copy
+import json
+import os
+import threading
 from fastapi.middleware.cors import CORSMiddleware
 
 # 기존 utils, prompt 임포트
 from utils import *
 from prompt import *
+from embedding_service import EmbeddingService, EMBED_MICRO_BATCHING
 
 # ===============================
 # Session State (멀티 세션 지원)
@@ -25,6 +32,8 @@ class SessionState:
     def __init__(self):
         self.model = None
         self.db_cache = None
+        self.catalog = None  # 세션이 사용 중인 CatalogVersion (세션이 끝날 때까지 고정)
+        self.persona_style_vectors = {}
         self.persona = None
         self.user_gender = None
         self.tpo_raw = None
@@ -34,13 +43,21 @@ class SessionState:
         self.selected_items = {}
         self.selected_context_text = ""
         self.hard_constraints_by_category = {}
-        self.negatives = {"fit": [], "pattern": [], "price_raw": 500000}
+        self.negatives = init_negatives()
         self.base_style_query = ""
         self.base_tpo_query = ""
+        # 세션 쿼리 벡터 캐시: ((persona, style_query, tpo_query), style_vec, tpo_vec)
+        # 요청 경로와 prefetch 워커 스레드가 함께 쓰므로 lock으로 보호
+        self.query_vectors = None
+        self.query_vectors_lock = threading.Lock()
         # 최근 추천 결과 캐시 (카테고리별)
         self.recent_recommendations = {}
         # 이전 추천 백업 (피드백으로 인해 빈 결과가 나올 때 사용)
         self.previous_recommendations = {}
+        # /select 직후 다음 카테고리 추천을 미리 계산하는 백그라운드 작업
+        self.prefetch_task = None
+        self.prefetch_inputs = None
+        self.prefetch_cancel = None  # 워커 스레드에 전달하는 취소 신호 (threading.Event)
         # 현재 진행 중인 카테고리
         self.current_category_index = 0
         self.categories = ["상의", "아우터", "바지", "신발", "가방"]
@@ -50,6 +67,7 @@ class SessionState:
         
     def reset_state_only(self):
         """상태만 초기화 (모델/DB는 유지)"""
+        self.cancel_prefetch()
         self.persona = None
         self.user_gender = None
         self.tpo_raw = None
@@ -59,9 +77,10 @@ class SessionState:
         self.selected_items = {}
         self.selected_context_text = ""
         self.hard_constraints_by_category = {}
-        self.negatives = {"fit": [], "pattern": [], "price_raw": 500000}
+        self.negatives = init_negatives()
         self.base_style_query = ""
         self.base_tpo_query = ""
+        self.query_vectors = None
         self.recent_recommendations = {}
         self.previous_recommendations = {}
         self.current_category_index = 0
@@ -84,6 +103,133 @@ class SessionState:
     def touch(self):
         """세션 접근 시간 갱신"""
         self.last_accessed = datetime.now()
+    
+    def get_query_vectors(self, persona, style_query, tpo_query):
+        """
+        세션 style / tpo 쿼리 벡터 반환
+        쿼리가 바뀌었을 때만 다시 인코딩 (세션당 1회, 카테고리마다 재인코딩하지 않음)
+        """
+        key = (persona, style_query, tpo_query)
+        with self.query_vectors_lock:
+            cached = self.query_vectors
+            if cached is not None and cached[0] == key:
+                return cached[1], cached[2]
+            
+            # 페르소나 기본 스타일 쿼리는 시작 시 계산한 테이블 사용
+            style_vec = None
+            if persona and style_query == safe_join(PERSONA_MOOD[persona]):
+                style_vec = self.persona_style_vectors.get(persona)
+            
+            queries = ([style_query] if style_vec is None else []) + [tpo_query]
+            vecs = embed_texts(queries, self.model)
+            tpo_vec = vecs[-1]
+            if style_vec is None:
+                style_vec = vecs[0]
+            
+            self.query_vectors = (key, style_vec, tpo_vec)
+            return style_vec, tpo_vec
+    
+    def start_prefetch(self, inputs):
+        """다음 카테고리 추천을 백그라운드에서 미리 계산"""
+        self.cancel_prefetch()
+        self.prefetch_inputs = inputs
+        self.prefetch_cancel = threading.Event()
+        self.prefetch_task = asyncio.create_task(
+            asyncio.to_thread(build_recommendation, self, inputs, self.prefetch_cancel)
+        )
+        self.prefetch_task.add_done_callback(_log_prefetch_failure)
+        print(f"🔮 [{inputs['category']}] 추천 prefetch 시작")
+    
+    @staticmethod
+    def _abandon_prefetch(task, cancel):
+        """
+        prefetch 결과 버리기
+        task.cancel()은 asyncio 래퍼만 취소하고 워커 스레드는 계속 실행되므로
+        cancel 신호를 보내 build_recommendation이 다음 단계(검색 / 리랭킹 / 이유 생성) 전에 멈추게 함
+        (이미 진행 중인 단계의 호출 1건은 끝까지 실행됨)
+        """
+        if cancel is not None:
+            cancel.set()
+        if task is not None and not task.done():
+            task.cancel()
+    
+    def drop_stale_prefetch(self):
+        """세션 상태(피드백 / negatives / TPO 등)가 바뀌어 prefetch 입력과 달라졌으면 바로 중단"""
+        inputs = self.prefetch_inputs
+        if inputs is not None and recommendation_inputs(self, inputs["category"]) != inputs:
+            print(f"♻️ [{inputs['category']}] 입력이 변경되어 prefetch를 중단합니다.")
+            self.cancel_prefetch()
+    
+    def cancel_prefetch(self):
+        """진행 중인 prefetch 중단 (결과는 버림)"""
+        self._abandon_prefetch(self.prefetch_task, self.prefetch_cancel)
+        self.prefetch_task = None
+        self.prefetch_inputs = None
+        self.prefetch_cancel = None
+    
+    async def take_prefetch(self, inputs):
+        """
+        prefetch 결과 꺼내기
+        입력이 그대로면 (True, 결과), 피드백 등으로 입력이 바뀌었거나 실패했으면 (False, None)
+        """
+        task, prefetch_inputs, cancel = self.prefetch_task, self.prefetch_inputs, self.prefetch_cancel
+        self.prefetch_task = None
+        self.prefetch_inputs = None
+        self.prefetch_cancel = None
+        
+        if task is None:
+            return False, None
+        
+        if prefetch_inputs != inputs:
+            self._abandon_prefetch(task, cancel)
+            print(f"♻️ [{inputs['category']}] 입력이 변경되어 prefetch 결과를 버리고 재계산합니다.")
+            return False, None
+        
+        try:
+            result = await task
+        except asyncio.CancelledError:
+            if task.cancelled():
+                return False, None
+            raise
+        except Exception as e:
+            print(f"⚠️ [{inputs['category']}] prefetch 실패, 재계산합니다: {e}")
+            return False, None
+        
+        print(f"⚡ [{inputs['category']}] prefetch 결과 사용")
+        return True, result
+
+def _log_prefetch_failure(task):
+    """await되지 않은 prefetch의 예외가 경고로 남지 않도록 처리"""
+    if task.cancelled():
+        return
+    if isinstance(task.exception(), RecommendationCancelled):
+        print("🛑 버려진 prefetch 중단")
+    elif task.exception() is not None:
+        print(f"⚠️ prefetch 작업 실패: {task.exception()}")
+
+# ===============================
+# Catalog Version (hot reload)
+# ===============================
+class CatalogVersion:
+    """FAISS / 메타데이터 캐시 한 버전 + 이 버전을 사용 중인 세션 수"""
+    def __init__(self, version, db_cache, style_root, tpo_root):
+        self.version = version
+        self.db_cache = db_cache
+        self.style_root = style_root
+        self.tpo_root = tpo_root
+        self.loaded_at = datetime.now()
+        self.refcount = 0
+        self.retired = False  # 새 버전으로 교체됨 (사용 중인 세션이 끝나면 해제)
+    
+    def info(self):
+        return {
+            "version": self.version,
+            "style_root": self.style_root,
+            "tpo_root": self.tpo_root,
+            "loaded_at": self.loaded_at.isoformat(),
+            "sessions": self.refcount,
+            "retired": self.retired
+        }
 
 # ===============================
 # Global Session Manager
@@ -92,7 +238,13 @@ class SessionManager:
     def __init__(self):
         self.sessions: Dict[str, SessionState] = {}
         self.global_model = None
-        self.global_db_cache = None
+        self.embedding_service = None  # 세션 간 micro-batching (global_model 래핑)
+        self.global_db_cache = None  # 현재 카탈로그 버전의 DB 캐시
+        self.catalog = None  # 현재 CatalogVersion (새 세션이 사용)
+        self.catalog_versions: Dict[int, CatalogVersion] = {}  # 아직 해제되지 않은 버전들
+        self.catalog_reload_task = None
+        self.catalog_reload_status = {"status": "idle"}
+        self.persona_style_vectors = {}  # persona -> base_style_query 임베딩 (float32)
         self.max_sessions = 20  # 최대 동시 세션 수
         
     def create_session(self) -> str:
@@ -113,8 +265,9 @@ class SessionManager:
         session = SessionState()
         
         # 전역 모델과 DB 공유 (메모리 절약)
-        session.model = self.global_model
-        session.db_cache = self.global_db_cache
+        session.model = self.embedding_service or self.global_model
+        self.pin_catalog(session)
+        session.persona_style_vectors = self.persona_style_vectors
         
         self.sessions[session_id] = session
         print(f"✅ 세션 생성: {session_id[:8]}... (총 세션 수: {len(self.sessions)})")
@@ -134,6 +287,8 @@ class SessionManager:
             session = self.sessions[session_id]
             
             # 세션 내부 큰 객체들 정리
+            session.cancel_prefetch()
+            self.unpin_catalog(session)
             session.recent_recommendations.clear()
             session.previous_recommendations.clear()
             session.selected_items.clear()
@@ -172,12 +327,98 @@ class SessionManager:
         # 임베딩 모델 로드
         self.global_model = load_embedding_model()
         
+        # 페르소나 스타일 쿼리 벡터 사전 계산 (6개 고정)
+        self.persona_style_vectors = build_persona_style_vectors(self.global_model)
+        
+        # 세션 간 encode 요청을 모아서 배치 실행
+        if EMBED_MICRO_BATCHING:
+            self.embedding_service = EmbeddingService(self.global_model)
+        
         # DB 캐시 로드
-        self.global_db_cache = load_all_dbs(STYLE_DB_ROOT, TPO_DB_ROOT, CATEGORY_ORDER)
+        db_cache = load_all_dbs(STYLE_DB_ROOT, TPO_DB_ROOT, CATEGORY_ORDER)
+        self.install_catalog(db_cache, STYLE_DB_ROOT, TPO_DB_ROOT)
         
         print("✅ 전역 리소스 로딩 완료!")
         print(f"   - 모델 디바이스: {'cuda' if torch.cuda.is_available() else 'cpu'}")
+        print(f"   - 페르소나 스타일 벡터: {len(self.persona_style_vectors)}개")
+        if self.embedding_service:
+            print(f"   - 임베딩 micro-batching: window={self.embedding_service.window * 1000:.1f}ms, max_batch={self.embedding_service.max_batch_size}")
         print(f"   - 최대 세션 수: {self.max_sessions}")
+    
+    # -------------------------------
+    # Catalog hot reload
+    # (refcount / 교체는 모두 이벤트 루프 스레드에서만 실행)
+    # -------------------------------
+    def install_catalog(self, db_cache, style_root, tpo_root):
+        """새 카탈로그 버전을 현재 버전으로 교체 (기존 세션은 이전 버전 유지)"""
+        version = self.catalog.version + 1 if self.catalog is not None else 1
+        new_catalog = CatalogVersion(version, db_cache, style_root, tpo_root)
+        old_catalog = self.catalog
+        self.catalog_versions[version] = new_catalog
+        self.catalog = new_catalog
+        self.global_db_cache = db_cache
+        print(f"📦 카탈로그 v{version} 적용")
+        
+        if old_catalog is not None:
+            old_catalog.retired = True
+            self._release_catalog_if_unused(old_catalog)
+        return new_catalog
+    
+    def pin_catalog(self, session: SessionState):
+        """세션을 현재 카탈로그 버전에 고정"""
+        self.unpin_catalog(session)
+        session.catalog = self.catalog
+        session.db_cache = self.catalog.db_cache if self.catalog else None
+        if self.catalog is not None:
+            self.catalog.refcount += 1
+    
+    def unpin_catalog(self, session: SessionState):
+        catalog = session.catalog
+        session.catalog = None
+        session.db_cache = None
+        if catalog is not None:
+            catalog.refcount -= 1
+            self._release_catalog_if_unused(catalog)
+    
+    def _release_catalog_if_unused(self, catalog: CatalogVersion):
+        if catalog.retired and catalog.refcount <= 0 and catalog.version in self.catalog_versions:
+            del self.catalog_versions[catalog.version]
+            catalog.db_cache = None
+            gc.collect()
+            print(f"🗑️ 카탈로그 v{catalog.version} 해제 (사용 중인 세션 없음)")
+    
+    def start_catalog_reload(self, style_root, tpo_root):
+        """새 카탈로그를 백그라운드에서 로드 → 검증 → 교체"""
+        if self.catalog_reload_task is not None and not self.catalog_reload_task.done():
+            raise HTTPException(status_code=409, detail="Catalog reload already in progress.")
+        self.catalog_reload_status = {
+            "status": "loading",
+            "style_root": style_root,
+            "tpo_root": tpo_root,
+            "started_at": datetime.now().isoformat()
+        }
+        self.catalog_reload_task = asyncio.create_task(self._reload_catalog(style_root, tpo_root))
+    
+    async def _reload_catalog(self, style_root, tpo_root):
+        print(f"🔄 카탈로그 리로드 시작: {style_root}, {tpo_root}")
+        dim = len(next(iter(self.persona_style_vectors.values()))) if self.persona_style_vectors else None
+        try:
+            db_cache = await asyncio.to_thread(load_all_dbs, style_root, tpo_root, CATEGORY_ORDER)
+            validate_db_cache(db_cache, CATEGORY_ORDER, dim)
+        except Exception as e:
+            print(f"❌ 카탈로그 리로드 실패 (기존 버전 유지): {e}")
+            self.catalog_reload_status.update(status="failed", error=str(e), finished_at=datetime.now().isoformat())
+            return
+        
+        catalog = self.install_catalog(db_cache, style_root, tpo_root)
+        self.catalog_reload_status.update(status="done", version=catalog.version, finished_at=datetime.now().isoformat())
+    
+    def catalog_stats(self):
+        return {
+            "current_version": self.catalog.version if self.catalog else None,
+            "versions": [c.info() for c in self.catalog_versions.values()],
+            "reload": self.catalog_reload_status
+        }
 
 # 전역 세션 매니저
 session_manager = SessionManager()
@@ -221,8 +462,9 @@ class CandidateItem(BaseModel):
     price: str
     item_url: str
     img_url: str
-    score: float
+    score: float  # FAISS 유사도 (style / tpo 중 먼저 검색된 쪽)
     reason: str
+    fused_score: Optional[float] = None  # 후보 순위를 정한 퓨전 점수
     sub_cat_name: Optional[str] = None
     color: Optional[str] = None
     fit: Optional[str] = None
@@ -246,6 +488,7 @@ class FeedbackResponse(BaseModel):
     status: str
     category: str
     message: str
+    eligible_count: Optional[int] = None  # 피드백 반영 후 조건을 만족하는 아이템 수
 
 class SelectRequest(BaseModel):
     product_id: str
@@ -290,6 +533,8 @@ async def lifespan(app: FastAPI):
     # 모든 세션 정리
     for session_id in list(session_manager.sessions.keys()):
         session_manager.delete_session(session_id)
+    if session_manager.embedding_service:
+        session_manager.embedding_service.stop()
 
 # ===============================
 # FastAPI App
@@ -312,6 +557,299 @@ app.add_middleware(
 CATEGORY_ORDER = ["상의", "아우터", "바지", "신발", "가방"]
 STYLE_DB_ROOT = "./faiss/style"
 TPO_DB_ROOT = "./faiss/tpo"
+PREFETCH_NEXT_CATEGORY = os.getenv("PREFETCH_NEXT_CATEGORY", "1") == "1"
+
+# ===============================
+# Recommendation Pipeline
+# ===============================
+def recommendation_inputs(session: SessionState, category: str) -> Dict[str, Any]:
+    """
+    해당 카테고리 추천 결과를 결정하는 입력 스냅샷
+    prefetch 결과를 그대로 써도 되는지 비교하는 key로도 사용
+    """
+    return {
+        "category": category,
+        "persona": session.persona,
+        "user_gender": session.user_gender,
+        "parsed_tpo": list(session.parsed_tpo),
+        "conflict": session.conflict,
+        "base_style_query": session.base_style_query,
+        "base_tpo_query": session.base_tpo_query,
+        "negatives": copy.deepcopy(session.negatives),
+        "hard_constraints": copy.deepcopy(session.hard_constraints_by_category[category]),
+        "selected_items": copy.deepcopy(session.selected_items),
+        "selected_context_text": session.selected_context_text,
+    }
+
+def retrieve_fused_candidates(session: SessionState, inputs: Dict[str, Any], db_cache):
+    """
+    retrieve → fuse 단계 (blocking)
+    반환: fused 후보 리스트 / 검색 결과가 하나도 없으면 None
+    """
+    category = inputs["category"]
+    
+    # 벡터 검색 전에 역색인으로 eligible 개수 확인 → 0개면 인코딩/검색 없이 바로 종료
+    eligible = count_eligible(
+        db_cache, category, inputs["persona"], inputs["user_gender"],
+        inputs["negatives"], inputs["hard_constraints"]
+    )
+    if eligible["style"] == 0 and eligible["tpo"] == 0:
+        print(f"⚠️ [{category}] 조건을 만족하는 아이템이 0개입니다. (검색 생략)")
+        return None
+    
+    # 세션 쿼리 벡터 (/session/tpo 때 계산된 것 재사용)
+    style_vec, tpo_vec = session.get_query_vectors(
+        inputs["persona"], inputs["base_style_query"], inputs["base_tpo_query"]
+    )
+    
+    # FAISS 검색 (style/tpo 인덱스 동시 검색)
+    style_items, tpo_items = retrieve_candidates_by_category_batched(
+        persona=inputs["persona"],
+        category=category,
+        style_query=inputs["base_style_query"],
+        tpo_query=inputs["base_tpo_query"],
+        db_cache=db_cache,
+        model=session.model,
+        negatives=inputs["negatives"],
+        user_gender=inputs["user_gender"],
+        hard_constraints=inputs["hard_constraints"],
+        topk=FUSION_POOL_SIZE if FUSION_MODE == "exact" else 5,
+        style_vec=style_vec,
+        tpo_vec=tpo_vec
+    )
+    
+    if not style_items and not tpo_items:
+        return None
+    
+    # 스코어 퓨전 (exact: 후보 합집합 전체에 대해 양쪽 유사도 계산)
+    if FUSION_MODE == "exact":
+        return fuse_candidates_exact(
+            style_items, tpo_items, inputs["conflict"], db_cache, category, style_vec, tpo_vec, topk=5
+        )
+    return fuse_candidates(style_items, tpo_items, inputs["conflict"], topk=5)
+
+def rerank_fused_candidates(inputs: Dict[str, Any], fused_candidates, db_cache):
+    """
+    LLM 리랭킹 (TOP-3) 단계 (blocking)
+    반환: (리랭킹 순서의 아이템 리스트, reason 리스트)
+    reason은 RERANK_MODE=fused로 리랭킹과 함께 생성된 경우에만 채워짐 (나머지는 None)
+    """
+    rerank_kwargs = dict(
+        persona=inputs["persona"],
+        parsed_tpo=inputs["parsed_tpo"],
+        conflict=inputs["conflict"],
+        fused_candidates=fused_candidates,
+        selected_items=inputs["selected_items"],
+        topk=3
+    )
+    ranked = rerank_and_explain(**rerank_kwargs) if RERANK_MODE == "fused" else None
+    if ranked is None:
+        ranked = [(pid, None) for pid in rerank_with_llm(**rerank_kwargs)]
+    
+    pid_index = db_cache["products"][inputs["category"]]["pid_index"]
+    items, reasons = [], []
+    for pid, reason in ranked:
+        item = lookup_item_by_id(pid, fused_candidates, pid_index)
+        if item is not None:
+            items.append(item)
+            reasons.append(reason)
+    return items, reasons
+
+def to_candidate_item(item, reason: str) -> CandidateItem:
+    return CandidateItem(
+        product_id=str(item.get('product_id')),
+        product_name=item.get('product_name', ''),
+        brand=item.get('brand', ''),
+        price=item.get('price', ''),
+        item_url=item.get('item_url', ''),
+        img_url=item.get('img_url', ''),
+        score=item.get('score', 0.0),
+        reason=reason,
+        fused_score=item.get('fused_score'),
+        sub_cat_name=item.get('sub_cat_name'),
+        color=item.get('color'),
+        fit=item.get('fit'),
+        pattern=item.get('pattern'),
+        texture=item.get('texture'),
+        description=item.get('description')
+    )
+
+class RecommendationCancelled(Exception):
+    """prefetch가 버려져 build_recommendation을 중간에 멈춤"""
+
+def _check_cancelled(cancel, category, stage):
+    if cancel is not None and cancel.is_set():
+        print(f"🛑 [{category}] prefetch 취소됨 ({stage} 전에 중단)")
+        raise RecommendationCancelled(category)
+
+def build_recommendation(session: SessionState, inputs: Dict[str, Any], cancel: Optional[threading.Event] = None):
+    """
+    retrieve → fuse → rerank_with_llm → generate_reason 전체 체인 (blocking, 워커 스레드에서 실행)
+    RERANK_MODE=fused면 rerank_and_explain 1회 호출로 리랭킹 + 이유 생성
+    세션 상태는 변경하지 않고 CandidateItem 리스트만 반환
+    검색 결과가 하나도 없으면 None
+    cancel(prefetch용)이 set되면 다음 단계로 넘어가기 전에 RecommendationCancelled
+    """
+    category = inputs["category"]
+    db_cache = session.db_cache  # 도중에 세션 카탈로그가 바뀌어도 한 버전으로 계산
+    
+    _check_cancelled(cancel, category, "retrieve")
+    fused_candidates = retrieve_fused_candidates(session, inputs, db_cache)
+    if fused_candidates is None:
+        return None
+    
+    _check_cancelled(cancel, category, "rerank")
+    items, reasons = rerank_fused_candidates(inputs, fused_candidates, db_cache)
+    
+    _check_cancelled(cancel, category, "reason")
+    # 이유가 없는 아이템만 추천 이유 생성 (아이템별 동시 호출, 결과는 리랭킹 순서 유지)
+    missing = [i for i, reason in enumerate(reasons) if not reason]
+    if missing:
+        reason_query = build_reason_query(inputs["persona"], inputs["parsed_tpo"])
+        generated = generate_reasons(reason_query, inputs["selected_context_text"], [items[i] for i in missing])
+        for i, reason in zip(missing, generated):
+            reasons[i] = reason
+    
+    return [to_candidate_item(item, reason) for item, reason in zip(items, reasons)]
+
+async def stream_reasons(inputs: Dict[str, Any], items, reasons):
+    """
+    아이템별 추천 이유를 토큰 단위로 스트리밍 (요청당 최대 REASON_CONCURRENCY개 동시 호출)
+    yield: ("reason_delta", i, 텍스트 조각) / ("candidate", i, 최종 reason)
+    - reasons[i]가 이미 있으면 (RERANK_MODE=fused) 바로 candidate
+    - 실패하거나 REASON_TIMEOUT 안에 끝나지 않으면 fallback_reason (candidate의 reason이 최종값)
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    semaphore = asyncio.Semaphore(REASON_CONCURRENCY)
+    reason_query = build_reason_query(inputs["persona"], inputs["parsed_tpo"])
+    deadline = loop.time() + REASON_TIMEOUT
+    
+    async def consume(i, parts):
+        async with semaphore:
+            async for delta in generate_reason_stream(
+                reason_query, inputs["selected_context_text"], item_description(items[i])
+            ):
+                parts.append(delta)
+                await queue.put(("reason_delta", i, delta))
+    
+    async def run(i):
+        if reasons[i]:
+            await queue.put(("candidate", i, reasons[i]))
+            return
+        parts = []
+        try:
+            await asyncio.wait_for(consume(i, parts), timeout=max(0.0, deadline - loop.time()))
+            reason = "".join(parts).strip()
+        except Exception as e:
+            reason = fallback_reason(items[i], e)
+        await queue.put(("candidate", i, reason))
+    
+    tasks = [asyncio.create_task(run(i)) for i in range(len(items))]
+    try:
+        remaining = len(items)
+        while remaining:
+            event = await queue.get()
+            if event[0] == "candidate":
+                remaining -= 1
+            yield event
+    finally:
+        # 클라이언트 연결이 끊기면 진행 중인 호출 취소
+        for task in tasks:
+            task.cancel()
+
+def commit_recommendation(session: SessionState, category: str, candidates) -> CurrentRecommendResponse:
+    """
+    추천 결과를 세션에 반영하고 응답 생성 (/recommend/next, /recommend/next/stream 공통)
+    candidates가 None이면 (검색 결과 없음) 이전 추천 결과 복구
+    """
+    # 검색 결과가 없을 경우: 이전 추천 결과 복구
+    if candidates is None:
+        # 이전 추천이 있는지 확인
+        if category in session.previous_recommendations:
+            print(f"⚠️ [{category}] 조건을 만족하는 아이템이 없습니다. 이전 추천 결과를 복구합니다.")
+            
+            # 이전 추천 결과를 현재 추천으로 복원
+            session.recent_recommendations[category] = session.previous_recommendations[category].copy()
+            
+            # 이전 candidates 복구
+            previous_candidates = list(session.previous_recommendations[category].values())
+            
+            return CurrentRecommendResponse(
+                category=category,
+                category_index=session.current_category_index,
+                total_categories=len(session.categories),
+                candidates=previous_candidates,
+                is_last_category=session.current_category_index == len(session.categories) - 1,
+                is_restored_from_previous=True
+            )
+        else:
+            # 이전 추천도 없는 경우
+            return CurrentRecommendResponse(
+                category=category,
+                category_index=session.current_category_index,
+                total_categories=len(session.categories),
+                candidates=[],
+                is_last_category=session.current_category_index == len(session.categories) - 1,
+                is_restored_from_previous=False
+            )
+    
+    # 🔥 핵심 수정: 현재 추천을 이전 추천에 누적 (기존 아이템 보존)
+    if category not in session.previous_recommendations:
+        session.previous_recommendations[category] = {}
+    
+    # 현재 recent_recommendations의 아이템들을 previous로 이동 (중복 없이)
+    if category in session.recent_recommendations:
+        for pid, item in session.recent_recommendations[category].items():
+            if pid not in session.previous_recommendations[category]:
+                session.previous_recommendations[category][pid] = item
+    
+    # 새 추천을 previous에도 추가 (중복 없이)
+    for item in candidates:
+        if item.product_id not in session.previous_recommendations[category]:
+            session.previous_recommendations[category][item.product_id] = item
+    
+    # 추천 결과를 세션에 캐시
+    session.recent_recommendations[category] = {
+        item.product_id: item for item in candidates
+    }
+    
+    # 메모리 정리 (임베딩 후)
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+    
+    return CurrentRecommendResponse(
+        category=category,
+        category_index=session.current_category_index,
+        total_categories=len(session.categories),
+        candidates=candidates,
+        is_last_category=session.current_category_index == len(session.categories) - 1,
+        is_restored_from_previous=False
+    )
+
+def current_recommendation_target(session: SessionState):
+    """추천 가능한 상태인지 확인 후 (현재 카테고리, 추천 입력) 반환"""
+    if not session.persona:
+        raise HTTPException(status_code=400, detail="Persona not set. Call /session/persona first.")
+    
+    if not session.parsed_tpo:
+        raise HTTPException(status_code=400, detail="TPO not set. Call /session/tpo first.")
+    
+    # 현재 카테고리 가져오기
+    category = session.get_current_category()
+    
+    if category is None:
+        raise HTTPException(
+            status_code=400, 
+            detail="All categories completed. Call /show_all to see final results."
+        )
+    
+    # 현재 카테고리의 추천 입력 (hard_constraints, negatives, 선택 아이템 등)
+    return category, recommendation_inputs(session, category)
+
+def sse_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
 
 # ===============================
 # Endpoints
@@ -372,6 +910,9 @@ async def reset_session(session_id: str = Header(..., alias="X-Session-ID")):
         session = session_manager.get_session(session_id)
         session.reset_state_only()
         
+        # 새 추천 흐름은 최신 카탈로그 버전 사용
+        session_manager.pin_catalog(session)
+        
         # hard_constraints 재초기화
         for cat in CATEGORY_ORDER:
             session.hard_constraints_by_category[cat] = init_hard_constraints()
@@ -402,6 +943,7 @@ async def set_persona(request: PersonaRequest, session_id: str = Header(..., ali
         session.persona = persona
         session.user_gender = GENDER_MAP[persona]
         session.base_style_query = safe_join(PERSONA_MOOD[persona])
+        session.drop_stale_prefetch()
         
         return PersonaResponse(
             persona=session.persona,
@@ -422,10 +964,40 @@ async def set_tpo(request: TPORequest, session_id: str = Header(..., alias="X-Se
             raise HTTPException(status_code=400, detail="Persona not set. Call /session/persona first.")
         
         session.tpo_raw = request.tpo
-        session.refined_tpo = refine_tpo_text(session.tpo_raw) 
-        session.parsed_tpo = parse_tpo(session.tpo_raw)
-        session.base_tpo_query = safe_join(session.parsed_tpo)
-        session.conflict = judge_conflict(session.persona, session.parsed_tpo)
+        if TPO_ANALYSIS_MODE == "combined":
+            # refine / parse / conflict를 structured output 1회 호출로
+            analysis = await analyze_tpo_async(session.persona, session.tpo_raw)
+            session.refined_tpo = analysis["refined_tpo"]
+            session.parsed_tpo = analysis["parsed_keywords"]
+            session.conflict = analysis["conflict"]
+            session.base_tpo_query = safe_join(session.parsed_tpo)
+
+            # 세션 쿼리 벡터 미리 계산 (이후 5개 카테고리에서 재사용)
+            await asyncio.to_thread(
+                session.get_query_vectors,
+                session.persona,
+                session.base_style_query,
+                session.base_tpo_query
+            )
+        else:
+            # refine / parse는 서로 독립 → 동시에 호출
+            session.refined_tpo, session.parsed_tpo = await asyncio.gather(
+                refine_tpo_text_async(session.tpo_raw),
+                parse_tpo_async(session.tpo_raw)
+            )
+            session.base_tpo_query = safe_join(session.parsed_tpo)
+
+            # conflict 판단(parsed_tpo 필요)과 세션 쿼리 벡터 계산(이후 5개 카테고리에서 재사용)을 동시에
+            session.conflict, _ = await asyncio.gather(
+                judge_conflict_async(session.persona, session.parsed_tpo),
+                asyncio.to_thread(
+                    session.get_query_vectors,
+                    session.persona,
+                    session.base_style_query,
+                    session.base_tpo_query
+                )
+            )
+        session.drop_stale_prefetch()
         
         return TPOResponse(
             parsed_tpo=session.parsed_tpo,
@@ -449,8 +1021,9 @@ async def set_negatives(request: NegativeRequest, session_id: str = Header(...,
         session.negatives = {
             "fit": [request.fit] if request.fit else [],
             "pattern": [request.pattern] if request.pattern else [],
-            "price_threshold": request.price_threshold if request.price_threshold else 500000
+            "price_threshold": request.price_threshold if request.price_threshold else DEFAULT_PRICE_THRESHOLD
         }
+        session.drop_stale_prefetch()
         
         return NegativeResponse(
             status="negatives_set",
@@ -469,158 +1042,77 @@ async def recommend_next_category(session_id: str = Header(..., alias="X-Session
     """
     try:
         session = session_manager.get_session(session_id)
+        category, inputs = current_recommendation_target(session)
         
-        if not session.persona:
-            raise HTTPException(status_code=400, detail="Persona not set. Call /session/persona first.")
-        
-        if not session.parsed_tpo:
-            raise HTTPException(status_code=400, detail="TPO not set. Call /session/tpo first.")
-        
-        # 현재 카테고리 가져오기
-        category = session.get_current_category()
-        
-        if category is None:
-            raise HTTPException(
-                status_code=400, 
-                detail="All categories completed. Call /show_all to see final results."
-            )
-        
-        # 현재 카테고리의 hard_constraints 가져오기
-        hard_constraints = session.hard_constraints_by_category[category]
-        
-        # 쿼리 준비
-        style_query = session.base_style_query
-        tpo_query = session.base_tpo_query
-        
-        # FAISS 검색
-        style_items, tpo_items = retrieve_candidates_by_category(
-            persona=session.persona,
-            category=category,
-            style_query=style_query,
-            tpo_query=tpo_query,
-            db_cache=session.db_cache,
-            model=session.model,
-            negatives=session.negatives,
-            user_gender=session.user_gender,
-            hard_constraints=hard_constraints,
-            topk=5
-        )
-        
-        # 검색 결과가 없을 경우: 이전 추천 결과 복구
-        if not style_items and not tpo_items:
-            # 이전 추천이 있는지 확인
-            if category in session.previous_recommendations:
-                print(f"⚠️ [{category}] 조건을 만족하는 아이템이 없습니다. 이전 추천 결과를 복구합니다.")
-                
-                # 이전 추천 결과를 현재 추천으로 복원
-                session.recent_recommendations[category] = session.previous_recommendations[category].copy()
-                
-                # 이전 candidates 복구
-                previous_candidates = list(session.previous_recommendations[category].values())
-                
-                return CurrentRecommendResponse(
-                    category=category,
-                    category_index=session.current_category_index,
-                    total_categories=len(session.categories),
-                    candidates=previous_candidates,
-                    is_last_category=session.current_category_index == len(session.categories) - 1,
-                    is_restored_from_previous=True
-                )
-            else:
-                # 이전 추천도 없는 경우
-                return CurrentRecommendResponse(
-                    category=category,
-                    category_index=session.current_category_index,
-                    total_categories=len(session.categories),
-                    candidates=[],
-                    is_last_category=session.current_category_index == len(session.categories) - 1,
-                    is_restored_from_previous=False
-                )
-        
-        # 스코어 퓨전
-        fused_candidates = fuse_candidates(style_items, tpo_items, session.conflict, topk=5)
-        
-        # LLM 리랭킹 (TOP-3)
-        top_item_ids = rerank_with_llm(
-            persona=session.persona,
-            parsed_tpo=session.parsed_tpo,
-            conflict=session.conflict,
-            fused_candidates=fused_candidates,
-            selected_items=session.selected_items,
-            topk=3
-        )
+        # /select 때 시작한 prefetch가 같은 입력으로 계산됐으면 그대로 사용
+        hit, candidates = await session.take_prefetch(inputs)
+        if not hit:
+            # 워커 스레드에서 실행해야 다른 세션의 encode 요청과 함께 배치될 수 있음
+            candidates = await asyncio.to_thread(build_recommendation, session, inputs)
         
-        # 추천 이유 생성
-        reason_query = build_reason_query(session.persona, session.parsed_tpo)
-        
-        candidates = []
-        for pid in top_item_ids:
-            item = lookup_item_by_id(pid, fused_candidates)
-            if item is None:
-                continue
-            
-            reason = generate_reason(
-                reason_query=reason_query,
-                selected_context_text=session.selected_context_text,
-                item_desc=f"{item.get('main_cat_name')}({item.get('sub_cat_name')}): {item.get('description')}"
-            )
-            
-            candidates.append(CandidateItem(
-                product_id=str(item.get('product_id')),
-                product_name=item.get('product_name', ''),
-                brand=item.get('brand', ''),
-                price=item.get('price', ''),
-                item_url=item.get('item_url', ''),
-                img_url=item.get('img_url', ''),
-                score=item.get('score', 0.0),
-                reason=reason,
-                sub_cat_name=item.get('sub_cat_name'),
-                color=item.get('color'),
-                fit=item.get('fit'),
-                pattern=item.get('pattern'),
-                texture=item.get('texture'),
-                description=item.get('description')
-            ))
-        
-        # 🔥 핵심 수정: 현재 추천을 이전 추천에 누적 (기존 아이템 보존)
-        if category not in session.previous_recommendations:
-            session.previous_recommendations[category] = {}
-        
-        # 현재 recent_recommendations의 아이템들을 previous로 이동 (중복 없이)
-        if category in session.recent_recommendations:
-            for pid, item in session.recent_recommendations[category].items():
-                if pid not in session.previous_recommendations[category]:
-                    session.previous_recommendations[category][pid] = item
-        
-        # 새 추천을 previous에도 추가 (중복 없이)
-        for item in candidates:
-            if item.product_id not in session.previous_recommendations[category]:
-                session.previous_recommendations[category][item.product_id] = item
-        
-        # 추천 결과를 세션에 캐시
-        session.recent_recommendations[category] = {
-            item.product_id: item for item in candidates
-        }
-        
-        # 메모리 정리 (임베딩 후)
-        gc.collect()
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
-        
-        return CurrentRecommendResponse(
-            category=category,
-            category_index=session.current_category_index,
-            total_categories=len(session.categories),
-            candidates=candidates,
-            is_last_category=session.current_category_index == len(session.categories) - 1,
-            is_restored_from_previous=False
-        )
+        return commit_recommendation(session, category, candidates)
         
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/recommend/next/stream")
+async def recommend_next_category_stream(session_id: str = Header(..., alias="X-Session-ID")):
+    """
+    /recommend/next의 Server-Sent Events 버전 (세션에 반영되는 결과는 동일)
+    event 순서:
+        fused        : FAISS 검색 + 스코어 퓨전 직후 후보 (reason은 빈 문자열)
+        reranked     : LLM 리랭킹 순서 {category, product_ids}
+        reason_delta : 추천 이유 토큰 조각 {index, product_id, delta}
+        candidate    : 추천 이유가 완성된 CandidateItem {index, candidate}
+        done         : 세션 반영 후 /recommend/next와 같은 CurrentRecommendResponse
+        error        : {detail}
+    prefetch 결과를 쓰면 fused / reason_delta 없이 reranked → candidate → done
+    """
+    session = session_manager.get_session(session_id)
+    category, inputs = current_recommendation_target(session)
+    
+    async def events():
+        try:
+            hit, candidates = await session.take_prefetch(inputs)
+            if hit and candidates is not None:
+                yield sse_event("reranked", {"category": category, "product_ids": [c.product_id for c in candidates]})
+                for i, candidate in enumerate(candidates):
+                    yield sse_event("candidate", {"index": i, "candidate": candidate.model_dump()})
+            elif not hit:
+                db_cache = session.db_cache  # 도중에 세션 카탈로그가 바뀌어도 한 버전으로 계산
+                fused_candidates = await asyncio.to_thread(retrieve_fused_candidates, session, inputs, db_cache)
+                if fused_candidates is not None:
+                    yield sse_event("fused", {
+                        "category": category,
+                        "candidates": [to_candidate_item(x, "").model_dump() for x in fused_candidates]
+                    })
+                    
+                    items, reasons = await asyncio.to_thread(rerank_fused_candidates, inputs, fused_candidates, db_cache)
+                    product_ids = [str(item.get("product_id")) for item in items]
+                    yield sse_event("reranked", {"category": category, "product_ids": product_ids})
+                    
+                    candidates = [None] * len(items)
+                    async for kind, i, value in stream_reasons(inputs, items, reasons):
+                        if kind == "reason_delta":
+                            yield sse_event(kind, {"index": i, "product_id": product_ids[i], "delta": value})
+                        else:
+                            candidates[i] = to_candidate_item(items[i], value)
+                            yield sse_event(kind, {"index": i, "candidate": candidates[i].model_dump()})
+            
+            # 모든 단계가 끝난 뒤에만 세션에 반영 (도중에 연결이 끊기면 세션은 그대로)
+            response = commit_recommendation(session, category, candidates)
+            yield sse_event("done", response.model_dump())
+        except Exception as e:
+            yield sse_event("error", {"detail": str(e)})
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.post("/feedback", response_model=FeedbackResponse)
 async def apply_feedback(request: FeedbackRequest, session_id: str = Header(..., alias="X-Session-ID")):
     """현재 카테고리에 대한 피드백 반영"""
@@ -658,11 +1150,19 @@ async def apply_feedback(request: FeedbackRequest, session_id: str = Header(...,
                     feedback_obj["include"].extend(alter)
         
         apply_feedback_to_constraints(feedback_obj, hard_constraints)
+        session.drop_stale_prefetch()
+        
+        # 반영된 조건으로 남는 아이템 수 (검색 없이 역색인으로 계산)
+        eligible = count_eligible(
+            session.db_cache, category, session.persona, session.user_gender,
+            session.negatives, hard_constraints
+        ) if session.persona else None
         
         return FeedbackResponse(
             status="feedback_applied",
             category=category,
-            message=f"{category} 카테고리에 피드백이 반영되었습니다. /recommend/next를 다시 호출하여 재추천을 받으세요."
+            message=f"{category} 카테고리에 피드백이 반영되었습니다. /recommend/next를 다시 호출하여 재추천을 받으세요.",
+            eligible_count=max(eligible.values()) if eligible else None
         )
         
     except HTTPException:
@@ -736,6 +1236,15 @@ async def select_item(request: SelectRequest, session_id: str = Header(..., alia
         next_category = session.get_current_category()
         is_complete = session.is_complete()
         
+        # 추천이 끝난 세션은 더 이상 DB를 쓰지 않음 → 교체된 카탈로그 버전을 바로 해제할 수 있도록 고정 해제
+        # (/show_all은 selected_items만 사용, /session/reset 시 최신 버전에 다시 고정)
+        if is_complete:
+            session_manager.unpin_catalog(session)
+        
+        # 다음 카테고리 입력이 모두 확정됐으므로 추천을 미리 계산
+        if PREFETCH_NEXT_CATEGORY and next_category is not None:
+            session.start_prefetch(recommendation_inputs(session, next_category))
+        
         return SelectResponse(
             status="selected",
             category=category,
@@ -787,6 +1296,7 @@ async def get_session_status(session_id: str = Header(..., alias="X-Session-ID")
         "initialized": session.model is not None and session.db_cache is not None,
         "model_loaded": session.model is not None,
         "db_loaded": session.db_cache is not None,
+        "catalog_version": session.catalog.version if session.catalog else None,
         "persona": session.persona,
         "user_gender": session.user_gender,
         "tpo_set": bool(session.parsed_tpo),
@@ -837,6 +1347,49 @@ async def manual_cleanup(max_age_minutes: int = 30):
         "active_sessions": len(session_manager.sessions)
     }
 
+@app.get("/admin/embedding_cache")
+async def get_embedding_cache_stats():
+    """관리자: 쿼리 임베딩 캐시 통계 (hit/miss/eviction)"""
+    return embedding_cache.stats()
+
+@app.get("/admin/search_stats")
+async def get_search_stats():
+    """관리자: FAISS 검색 깊이(k) 히스토그램 / 결과 부족 횟수"""
+    return search_stats.stats()
+
+@app.get("/admin/llm_cache")
+async def get_llm_cache_stats():
+    """관리자: LLM 응답 캐시 호출 지점별 hit rate / 평균 지연시간"""
+    return llm_cache.stats()
+
+@app.delete("/admin/llm_cache")
+async def clear_llm_cache():
+    """관리자: LLM 응답 캐시 비우기"""
+    llm_cache.clear()
+    return {"status": "cleared"}
+
+@app.post("/admin/catalog/reload", status_code=202)
+async def reload_catalog():
+    """
+    관리자: 재빌드된 카탈로그를 무중단으로 교체
+    백그라운드에서 로드/검증 후 새 세션부터 적용, 진행 중인 세션은 기존 버전을 끝까지 사용
+    (경로는 요청으로 받지 않고 설정된 STYLE_DB_ROOT / TPO_DB_ROOT만 다시 읽음 → build_index.py로 같은 경로에 재빌드)
+    """
+    session_manager.start_catalog_reload(STYLE_DB_ROOT, TPO_DB_ROOT)
+    return {"status": "loading", "current_version": session_manager.catalog.version if session_manager.catalog else None}
+
+@app.get("/admin/catalog")
+async def get_catalog_status():
+    """관리자: 카탈로그 버전별 사용 세션 수 / 리로드 상태"""
+    return session_manager.catalog_stats()
+
+@app.get("/admin/embedding_service")
+async def get_embedding_service_stats():
+    """관리자: 임베딩 micro-batching 큐 깊이 / 배치 크기 히스토그램"""
+    if session_manager.embedding_service is None:
+        return {"enabled": False}
+    return {"enabled": True, **session_manager.embedding_service.stats()}
+
 
 @app.post("/generate_qr", response_model=QRCodeResponse)
 async def generate_qr_code(request: QRCodeRequest):
@@ -0,0 +1,290 @@
+"""
+컬럼형 메타데이터 저장소
+
+metadata.jsonl을 row마다 dict로 들고 있는 대신 필드별 NumPy 배열로 보관한다.
+- 범주형 속성(성별, 서브카테고리, 핏, 패턴, 소재, 색상 등): 사전 인코딩된 int 코드 + vocab
+- 가격(price_raw): int64 배열
+- 자유 텍스트(상품명, 설명, URL 등): intern된 문자열 object 배열
+
+필터는 코드 배열로 만든 속성 역색인(attribute_index.AttributeIndex) 비트셋으로 처리하고,
+Python dict는 최종 반환되는 몇 개 아이템에 대해서만 row(i)로 만든다.
+
+컬럼은 바이너리 스냅샷(metadata.colstore)으로 저장해 mmap으로 열 수 있다.
+스냅샷 포맷:
+    MAGIC(8B) | header 길이(uint64 LE) | header JSON | 8바이트 정렬된 컬럼 버퍼들
+    - 범주형/정수 컬럼: raw 배열 (header에 dtype / offset / 개수)
+    - 텍스트 컬럼: utf-8 blob + int64 offsets(n+1), None인 row는 header의 nulls 목록
+여러 uvicorn 워커가 같은 파일을 mmap하면 page cache의 물리 메모리를 공유한다.
+"""
+import json
+import mmap
+import os
+import struct
+import sys
+
+import numpy as np
+
+# 사전 인코딩할 범주형 필드 (DETAIL_MAP / NEGATIVE_MAP 속성 포함)
+CATEGORICAL_FIELDS = (
+    "gender", "main_cat_name", "sub_cat_name", "style", "fit",
+    "pattern", "texture", "color", "mood", "brand",
+)
+INT_FIELDS = ("price_raw",)
+
+MISSING = -1  # 범주형 결측 코드
+
+SNAPSHOT_MAGIC = b"CORDEMD1"
+SNAPSHOT_NAME = "metadata.colstore"
+
+
+def main_color_of(color):
+    # 주요 색상 = color의 첫 번째 값
+    return (color or "").split(", ")[0]
+
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class PackedStrings:
+    """mmap된 utf-8 blob + offsets 위의 문자열 컬럼 (row 접근 시에만 decode)"""
+    def __init__(self, blob, offsets, nulls=()):
+        self.blob = blob
+        self.offsets = offsets
+        self.nulls = frozenset(nulls)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        i = int(i)
+        if i in self.nulls:
+            return None
+        return bytes(self.blob[self.offsets[i]:self.offsets[i + 1]]).decode("utf-8")
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+class MetadataStore:
+    def __init__(self, fields, columns, vocabs):
+        self.fields = list(fields)      # 원본 필드 순서 (row dict 재구성용)
+        self.columns = columns          # name -> np.ndarray (코드 / 값)
+        self.vocabs = vocabs            # 범주형 name -> 값 리스트 (code = index)
+        self._n = len(next(iter(columns.values()))) if columns else 0
+        self._mmap = None  # 스냅샷에서 열었을 때 mmap 객체 유지
+
+    # -------------------------------
+    # Build
+    # -------------------------------
+    @classmethod
+    def from_records(cls, records):
+        fields = []
+        for r in records:
+            for k in r:
+                if k not in fields:
+                    fields.append(k)
+
+        columns, vocabs = {}, {}
+        for name in fields:
+            values = [r.get(name) for r in records]
+            if name in CATEGORICAL_FIELDS:
+                columns[name], vocabs[name] = cls._encode(values)
+            elif name in INT_FIELDS:
+                columns[name] = np.array([v if v is not None else 0 for v in values], dtype=np.int64)
+            else:
+                col = np.empty(len(values), dtype=object)
+                col[:] = [_intern(v) for v in values]
+                columns[name] = col
+
+        # 파생 컬럼 (row dict에는 포함되지 않음)
+        if "color" in fields:
+            columns["main_color"], vocabs["main_color"] = cls._encode(
+                [main_color_of(r.get("color")) for r in records]
+            )
+        return cls(fields, columns, vocabs)
+
+    @classmethod
+    def from_jsonl(cls, path):
+        with open(path, encoding="utf-8") as f:
+            return cls.from_records([json.loads(l) for l in f if l.strip()])
+
+    @staticmethod
+    def _encode(values):
+        vocab, code_map = [], {}
+        codes = np.empty(len(values), dtype=np.int32)
+        for i, v in enumerate(values):
+            if v is None:
+                codes[i] = MISSING
+                continue
+            if v not in code_map:
+                code_map[v] = len(vocab)
+                vocab.append(_intern(v))
+            codes[i] = code_map[v]
+        return codes, vocab
+
+    # -------------------------------
+    # Row access (최종 아이템만 dict로)
+    # -------------------------------
+    def __len__(self):
+        return self._n
+
+    def value(self, name, i):
+        col = self.columns[name]
+        if name in self.vocabs:
+            code = col[i]
+            return None if code == MISSING else self.vocabs[name][code]
+        v = col[i]
+        return v.item() if isinstance(v, np.generic) else v
+
+    def row(self, i):
+        i = int(i)
+        return {name: self.value(name, i) for name in self.fields}
+
+    def rows(self, ids):
+        return [self.row(i) for i in ids]
+
+    def __getitem__(self, i):
+        return self.row(i)
+
+    # -------------------------------
+    # Binary snapshot (mmap)
+    # -------------------------------
+    def write_snapshot(self, path):
+        """컬럼을 바이너리 스냅샷으로 저장 (임시 파일에 쓴 뒤 교체)"""
+        buffers = []
+        header = {"version": 1, "n": self._n, "fields": self.fields, "vocabs": self.vocabs, "columns": {}}
+        pos = 0
+
+        def add(buf):
+            nonlocal pos
+            pad = (-pos) % 8
+            buffers.append(b"\0" * pad)
+            pos += pad
+            start = pos
+            buffers.append(buf)
+            pos += len(buf)
+            return start
+
+        for name, col in self.columns.items():
+            if isinstance(col, np.ndarray) and col.dtype != object:
+                arr = np.ascontiguousarray(col)
+                header["columns"][name] = {
+                    "kind": "array",
+                    "dtype": arr.dtype.str,
+                    "offset": add(arr.tobytes()),
+                    "count": len(arr)
+                }
+                continue
+
+            values = list(col)
+            if any(v is not None and not isinstance(v, str) for v in values):
+                raise TypeError(f"column {name} has non-string values; cannot snapshot")
+            encoded = [(v or "").encode("utf-8") for v in values]
+            offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+            np.cumsum([len(b) for b in encoded], out=offsets[1:])
+            header["columns"][name] = {
+                "kind": "text",
+                "offsets": add(offsets.tobytes()),
+                "blob": add(b"".join(encoded)),
+                "blob_size": int(offsets[-1]),
+                "nulls": [i for i, v in enumerate(values) if v is None]
+            }
+
+        header_bytes = json.dumps(header, ensure_ascii=False).encode("utf-8")
+        prefix = SNAPSHOT_MAGIC + struct.pack("<Q", len(header_bytes)) + header_bytes
+        prefix += b"\0" * ((-len(prefix)) % 8)
+
+        tmp_path = f"{path}.tmp.{os.getpid()}"
+        with open(tmp_path, "wb") as f:
+            f.write(prefix)
+            for buf in buffers:
+                f.write(buf)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def open_snapshot(cls, path):
+        """스냅샷을 mmap으로 열기 (컬럼은 복사 없이 mmap 위의 view)"""
+        with open(path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if mm[:8] != SNAPSHOT_MAGIC:
+            mm.close()
+            raise ValueError(f"{path}: not a metadata snapshot")
+        (header_len,) = struct.unpack("<Q", mm[8:16])
+        header = json.loads(mm[16:16 + header_len].decode("utf-8"))
+        base = 16 + header_len
+        base += (-base) % 8
+
+        columns = {}
+        for name, spec in header["columns"].items():
+            if spec["kind"] == "array":
+                columns[name] = np.frombuffer(mm, dtype=np.dtype(spec["dtype"]), count=spec["count"], offset=base + spec["offset"])
+            else:
+                offsets = np.frombuffer(mm, dtype=np.int64, count=header["n"] + 1, offset=base + spec["offsets"])
+                blob = memoryview(mm)[base + spec["blob"]:base + spec["blob"] + spec["blob_size"]]
+                columns[name] = PackedStrings(blob, offsets, spec["nulls"])
+
+        store = cls(header["fields"], columns, header["vocabs"])
+        store._n = header["n"]
+        store._mmap = mm
+        return store
+
+
+def build_product_table(stores, key="product_id"):
+    """
+    여러 인덱스(style / tpo)의 메타데이터를 product_id 기준 하나의 상품 테이블로 합침
+    - 상품마다 dense int id(pid) 부여 (처음 등장한 row의 속성이 기준)
+    - 인덱스마다 row → pid 배열 (row 순서가 pid와 같으면 None)
+
+    첫 번째 store에 중복/추가 상품이 없으면 그대로(mmap 포함) 상품 테이블로 사용하고,
+    그렇지 않을 때만 합친 row들로 새 store를 만든다.
+    반환: (product store, {product_id: pid}, [row→pid 배열 or None, ...])
+    """
+    pid_index = {}
+    sources = []  # pid 순서대로 (store, row)
+    row_maps = []
+    for store in stores:
+        rows = np.empty(len(store), dtype=np.int64)
+        for i in range(len(store)):
+            product_id = str(store.value(key, i))
+            pid = pid_index.get(product_id)
+            if pid is None:
+                pid = pid_index[product_id] = len(sources)
+                sources.append((store, i))
+            rows[i] = pid
+        row_maps.append(rows)
+
+    primary = stores[0]
+    if len(sources) == len(primary) and all(s is primary for s, _ in sources):
+        table = primary
+    else:
+        table = MetadataStore.from_records([s.row(i) for s, i in sources])
+
+    row_maps = [
+        None if len(rows) == len(table) and np.array_equal(rows, np.arange(len(rows))) else rows
+        for rows in row_maps
+    ]
+    return table, pid_index, row_maps
+
+
+def load_metadata(db_dir, use_snapshot=True):
+    """
+    db_dir의 메타데이터 로드
+    - 스냅샷이 없거나 metadata.jsonl이 더 최신이면 스냅샷을 다시 생성
+    - 스냅샷 생성/열기에 실패하면 JSONL에서 직접 로드 (fallback)
+    """
+    jsonl_path = os.path.join(db_dir, "metadata.jsonl")
+    if not use_snapshot:
+        return MetadataStore.from_jsonl(jsonl_path)
+
+    snapshot_path = os.path.join(db_dir, SNAPSHOT_NAME)
+    store = None
+    try:
+        if not os.path.exists(snapshot_path) or os.path.getmtime(snapshot_path) < os.path.getmtime(jsonl_path):
+            print(f"  👉 metadata snapshot 생성: {snapshot_path}")
+            store = MetadataStore.from_jsonl(jsonl_path)
+            store.write_snapshot(snapshot_path)
+        return MetadataStore.open_snapshot(snapshot_path)
+    except Exception as e:
+        print(f"  ⚠️ metadata snapshot 사용 불가 ({snapshot_path}): {e} → JSONL 로드")
+        return store if store is not None else MetadataStore.from_jsonl(jsonl_path)
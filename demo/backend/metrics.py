@@ -0,0 +1,30 @@
+"""
+운영 지표용 간단한 히스토그램 (임베딩 배치, FAISS 검색 깊이 등)
+"""
+
+
+class Histogram:
+    """고정 bucket(상한값 기준) 카운트 히스토그램"""
+    def __init__(self, bounds):
+        self.bounds = list(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)  # 마지막 bucket: 최대 상한 초과
+        self.total = 0
+        self.sum = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.bounds):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.total += 1
+        self.sum += value
+
+    def snapshot(self):
+        labels = [f"<={b}" for b in self.bounds] + [f">{self.bounds[-1]}"]
+        return {
+            "buckets": dict(zip(labels, self.counts)),
+            "count": self.total,
+            "mean": round(self.sum / self.total, 3) if self.total else 0.0
+        }
@@ -5,7 +5,7 @@ os.environ['OMP_NUM_THREADS'] = '1'
 import json
 import faiss
 import torch
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
 from dotenv import load_dotenv
 from prompt import *
 from sentence_transformers import SentenceTransformer
@@ -17,10 +17,23 @@ import os
 from datetime import datetime
 from pydantic import BaseModel, EmailStr
 from pathlib import Path
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from metrics import Histogram
+from metadata_store import MetadataStore, build_product_table, load_metadata, main_color_of
+from attribute_index import AttributeIndex
+import asyncio
+import threading
+import time
+import unicodedata
 
 
 
 load_dotenv('.env', override=True)
+
+# .env의 LLM_CACHE_* 설정을 읽도록 load_dotenv 이후에 임포트
+from llm_cache import llm_cache
+
 API_KEY = os.getenv("OPENAI_API_KEY")
 
 
@@ -30,6 +43,23 @@ USER_LOOKBOOKS_DIR = LOOKBOOK_DIR / "user_lookbooks"
 LOOKBOOK_DIR.mkdir(exist_ok=True)
 USER_LOOKBOOKS_DIR.mkdir(exist_ok=True)
 
+EMBEDDING_MODEL_NAME = "upskyy/bge-m3-korean"
+# 임베딩 백엔드: "torch" (기본, fp32) / "onnx" / "onnx-int8" (CPU 동적 양자화)
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch")
+ONNX_MODEL_DIR = os.getenv("ONNX_MODEL_DIR", "./onnx_model")  # embedding_backend.py export 결과 경로
+METADATA_SNAPSHOT = os.getenv("METADATA_SNAPSHOT", "1") == "1"  # metadata.colstore mmap 스냅샷 사용 여부
+FAISS_INDEX_VARIANT = os.getenv("FAISS_INDEX_VARIANT", "flat")  # flat / ivf / hnsw / sq8 / pq (index.<variant>.faiss, 없으면 flat)
+COMPRESSED_VARIANTS = ("sq8", "pq")  # 압축 코드로 1차 검색하는 variant
+FAISS_RESCORE = os.getenv("FAISS_RESCORE", "1") == "1"  # 압축 variant의 후보를 flat 벡터로 exact 재스코어링
+FAISS_RESCORE_K_FACTOR = int(os.getenv("FAISS_RESCORE_K_FACTOR", "4"))  # 재스코어링 후보 수 = k * factor
+# 성별 × 페르소나 제외 조건별 flat 서브 인덱스 사용 (opt-in)
+# 서브 인덱스는 heap에 벡터를 복사하므로 카테고리 flat 인덱스의 약 1.6~2배 메모리를 추가로 사용 (mmap 공유 안 됨)
+FAISS_PARTITIONS = os.getenv("FAISS_PARTITIONS", "0") == "1"
+FAISS_NPROBE = int(os.getenv("FAISS_NPROBE", "16"))  # IVF: 검색할 클러스터 수
+FAISS_EF_SEARCH = int(os.getenv("FAISS_EF_SEARCH", "64"))  # HNSW: 검색 후보 리스트 크기
+ONNX_QUANT_CONFIG = os.getenv("ONNX_QUANT_CONFIG", "avx512_vnni")  # arm64 / avx2 / avx512 / avx512_vnni
+EMBED_CACHE_SIZE = int(os.getenv("EMBED_CACHE_SIZE", "1024"))  # 쿼리 임베딩 LRU 캐시 최대 개수
+
 PERSONA_MAP = {
     1: "pme",
     2: "nowon",
@@ -54,6 +84,8 @@ NEGATIVE_MAP = {
     }
 }
 
+DEFAULT_PRICE_THRESHOLD = 500000  # 가격 상한 기본값 (/session/negatives에서 따로 정하지 않은 경우)
+
 GENDER_MAP = {
     "pme": "남자",
     "nowon": "남자",
@@ -140,54 +172,402 @@ def safe_join(parts):
 # 1. Load Model & DB
 # ===============================
 
-def load_embedding_model():
+def onnx_file_name(backend: str) -> str:
+    """ONNX_MODEL_DIR 안의 백엔드별 ONNX 그래프 경로"""
+    if backend == "onnx-int8":
+        return f"onnx/model_qint8_{ONNX_QUANT_CONFIG}.onnx"
+    return "onnx/model.onnx"
+
+def load_embedding_model(backend: str = None):
+    backend = backend or EMBEDDING_BACKEND
+    if backend not in ("torch", "onnx", "onnx-int8"):
+        raise ValueError(f"Unknown EMBEDDING_BACKEND: {backend} (torch / onnx / onnx-int8)")
+
     device = "cuda" if torch.cuda.is_available() else "cpu"
-    print(f"➡️ DEVICE: {device}")
+    if backend != "torch":
+        device = "cpu"  # ONNX Runtime CPU 전용
+    print(f"➡️ DEVICE: {device} / BACKEND: {backend}")
     print("👉 Embedding model is loading...")
-    model = SentenceTransformer("upskyy/bge-m3-korean", device=device)
+
+    if backend == "torch":
+        model = SentenceTransformer(EMBEDDING_MODEL_NAME, device=device)
+        model.model_id = EMBEDDING_MODEL_NAME
+    else:
+        file_name = onnx_file_name(backend)
+        if not os.path.exists(os.path.join(ONNX_MODEL_DIR, file_name)):
+            raise FileNotFoundError(
+                f"{os.path.join(ONNX_MODEL_DIR, file_name)} not found. "
+                f"Run `python embedding_backend.py export --out {ONNX_MODEL_DIR}` first."
+            )
+        model = SentenceTransformer(
+            ONNX_MODEL_DIR,
+            device=device,
+            backend="onnx",
+            model_kwargs={"file_name": file_name}
+        )
+        # 백엔드별로 벡터가 미세하게 다르므로 임베딩 캐시 key도 분리
+        model.model_id = f"{EMBEDDING_MODEL_NAME}:{backend}"
     model.eval()
     return model
 
+
+class EmbeddingCache:
+    """
+    프로세스 전역 쿼리 임베딩 LRU 캐시
+    key: (모델 id, 정규화된 쿼리 텍스트) / value: float32 벡터
+    """
+    def __init__(self, max_size: int = EMBED_CACHE_SIZE):
+        self.max_size = max_size
+        self._store = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(text: str, model):
+        # 공백/유니코드 정규화 → 같은 문장은 같은 key
+        normalized = " ".join(unicodedata.normalize("NFC", str(text)).split())
+        model_id = getattr(model, "model_id", None) or EMBEDDING_MODEL_NAME
+        return (model_id, normalized)
+
+    def get(self, key):
+        with self._lock:
+            vec = self._store.get(key)
+            if vec is None:
+                self.misses += 1
+                return None
+            self._store.move_to_end(key)
+            self.hits += 1
+            return vec.copy()  # 호출자가 in-place 수정해도 캐시는 안전
+
+    def put(self, key, vec):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._store[key] = vec.copy()
+            self._store.move_to_end(key)
+            while len(self._store) > self.max_size:
+                self._store.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._store.clear()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._store),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0
+            }
+
+
+embedding_cache = EmbeddingCache()
+
 def embed_text(text: str, model):
+    key = embedding_cache.make_key(text, model)
+    cached = embedding_cache.get(key)
+    if cached is not None:
+        return cached
+
     with torch.no_grad():
         vec = model.encode(
             text,
             convert_to_numpy=True,
             normalize_embeddings=True
         )
-    return vec.astype("float32")
+    vec = vec.astype("float32")
+    embedding_cache.put(key, vec)
+    return vec
 
+def embed_texts(texts: List[str], model):
+    """
+    여러 쿼리를 한 번의 forward pass로 인코딩 (캐시 hit은 제외하고 miss만 배치)
+    반환: (len(texts), dim) float32
+    """
+    keys = [embedding_cache.make_key(t, model) for t in texts]
+    vecs = [embedding_cache.get(k) for k in keys]
+    miss_idx = [i for i, v in enumerate(vecs) if v is None]
+
+    if miss_idx:
+        with torch.no_grad():
+            encoded = model.encode(
+                [texts[i] for i in miss_idx],
+                convert_to_numpy=True,
+                normalize_embeddings=True
+            )
+        encoded = encoded.astype("float32")
+        for row, i in enumerate(miss_idx):
+            vecs[i] = encoded[row]
+            embedding_cache.put(keys[i], encoded[row])
+
+    return np.stack(vecs).astype("float32")
 
-def load_db(db_dir):
-    index_path = os.path.join(db_dir, "index.faiss")
+def build_persona_style_vectors(model):
+    """
+    페르소나별 base_style_query(safe_join(PERSONA_MOOD[p]))는 고정이므로
+    서버 시작 시 한 번에 인코딩해 persona → float32 벡터 테이블로 보관
+    """
+    personas = list(PERSONA_MOOD.keys())
+    queries = [safe_join(PERSONA_MOOD[p]) for p in personas]
+    with torch.no_grad():
+        vecs = model.encode(
+            queries,
+            convert_to_numpy=True,
+            normalize_embeddings=True
+        )
+    vecs = vecs.astype("float32")
+    return {p: vecs[i] for i, p in enumerate(personas)}
+
+
+def index_file_name(variant: str) -> str:
+    return "index.faiss" if variant == "flat" else f"index.{variant}.faiss"
+
+def read_faiss_index(index_path):
+    try:
+        return faiss.read_index(index_path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+    except RuntimeError:
+        # mmap을 지원하지 않는 인덱스 타입
+        return faiss.read_index(index_path)
+
+def load_db(db_dir, variant=None):
+    variant = variant or FAISS_INDEX_VARIANT
+    index_path = os.path.join(db_dir, index_file_name(variant))
+    if not os.path.exists(index_path):
+        if variant != "flat":
+            print(f"  ⚠️ {index_path} 없음 → flat 인덱스 사용")
+        variant = "flat"
+        index_path = os.path.join(db_dir, index_file_name(variant))
     # index = faiss.read_index(index_path)
-    index = faiss.read_index(index_path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
-    metas = [json.loads(l) for l in open(os.path.join(db_dir, "metadata.jsonl"), encoding="utf-8")]
+    index = read_faiss_index(index_path)
+
+    # 압축 코드(SQ8 / PQ)로 후보를 뽑고, mmap된 flat 벡터로 후보만 exact 재스코어링
+    # → score가 코사인 유사도 그대로 유지되고, flat 파일은 후보 row의 page만 읽힘
+    if variant in COMPRESSED_VARIANTS and FAISS_RESCORE:
+        flat = read_faiss_index(os.path.join(db_dir, index_file_name("flat")))
+        index = faiss.IndexRefine(index, flat)
+    # 필드별 컬럼 배열 + 범주형 코드 (row dict는 반환 시점에만 생성)
+    # metadata.colstore 스냅샷을 mmap으로 열어 워커 간 page cache 공유
+    metas = load_metadata(db_dir, use_snapshot=METADATA_SNAPSHOT)
     return index, metas
 
 
+def load_vector_source(db_dir, index):
+    """
+    exact 유사도 재계산용 원본 벡터 (reconstruct_batch 지원 flat 인덱스, mmap)
+    검색 인덱스가 flat이 아니면 같은 폴더의 index.faiss를 따로 연다
+    """
+    if isinstance(index, faiss.IndexFlat):
+        return index
+    if isinstance(index, faiss.IndexRefine):
+        return faiss.downcast_index(index.refine_index)
+    return read_faiss_index(os.path.join(db_dir, index_file_name("flat")))
+
+def invert_rows(rows, n_products, n_rows):
+    """row → pid 배열의 역방향 (pid → row, 인덱스에 없는 상품은 -1)"""
+    pid_rows = np.full(n_products, -1, dtype=np.int64)
+    pid_rows[np.arange(n_rows) if rows is None else rows] = np.arange(n_rows)
+    return pid_rows
+
 def load_all_dbs(style_root, tpo_root, categories):
-    db_cache = {"style": {}, "tpo": {}}
+    """
+    db_cache 구조
+    - db_cache["products"][cat]: 카테고리별 상품 테이블 1개 (style / tpo 공용)
+        {"meta": MetadataStore, "attr_index": AttributeIndex, "pid_index": {product_id: pid}}
+    - db_cache["style" | "tpo"][cat]: FAISS 인덱스 + row → pid 배열 ("rows", 순서가 같으면 None)
+        "pid_rows"(pid → row)와 "vectors"(flat 원본 벡터)는 exact 퓨전용
+        "meta" / "attr_index"는 상품 테이블과 같은 객체를 가리킴
+    """
+    db_cache = {"style": {}, "tpo": {}, "products": {}}
     print("👉 DB cache is loading...")
     for cat in categories:
         # tpo DB는 항상 존재
-        db_cache["tpo"][cat] = {}
-        db_cache["tpo"][cat]["index"], db_cache["tpo"][cat]["meta"] = load_db(
-            os.path.join(tpo_root, cat)
-        )
+        tpo_index, tpo_meta = load_db(os.path.join(tpo_root, cat))
 
         # style DB는 있는 경우만
         style_cat_dir = os.path.join(style_root, cat)
-        if os.path.exists(style_cat_dir):
-            db_cache["style"][cat] = {}
-            db_cache["style"][cat]["index"], db_cache["style"][cat]["meta"] = load_db(
-                style_cat_dir
-            )
+        style_index, style_meta = load_db(style_cat_dir) if os.path.exists(style_cat_dir) else (None, None)
+
+        # style / tpo 메타데이터를 product_id 기준 하나의 상품 테이블로 합침
+        stores = [tpo_meta] + ([style_meta] if style_meta is not None else [])
+        table, pid_index, row_maps = build_product_table(stores)
+
+        # 속성 역색인은 상품 테이블 기준으로 1회만 계산 (FAISS IDSelector로 pushdown)
+        products = {"meta": table, "attr_index": build_attribute_index(table), "pid_index": pid_index}
+        db_cache["products"][cat] = products
+
+        db_cache["tpo"][cat] = {
+            "index": tpo_index,
+            "rows": row_maps[0],
+            "pid_rows": invert_rows(row_maps[0], len(table), tpo_index.ntotal),
+            "vectors": load_vector_source(os.path.join(tpo_root, cat), tpo_index),
+            "meta": products["meta"],
+            "attr_index": products["attr_index"],
+            "partitions": build_partitions(tpo_index, products["attr_index"], row_maps[0])
+        }
+        if style_index is not None:
+            db_cache["style"][cat] = {
+                "index": style_index,
+                "rows": row_maps[1],
+                "pid_rows": invert_rows(row_maps[1], len(table), style_index.ntotal),
+                "vectors": load_vector_source(style_cat_dir, style_index),
+                "meta": products["meta"],
+                "attr_index": products["attr_index"],
+                "partitions": build_partitions(style_index, products["attr_index"], row_maps[1])
+            }
         else:
             db_cache["style"][cat] = None  # 🔥 중요
 
     return db_cache
 
+def validate_db_cache(db_cache, categories, dim=None):
+    """
+    새로 로드한 DB 캐시 검증 (hot reload 전에 실행)
+    - 카테고리마다 tpo DB / 상품 테이블 존재
+    - 인덱스 ntotal == 메타데이터 row 수
+    - 인덱스 차원 == 임베딩 차원
+    문제가 있으면 ValueError
+    """
+    problems = []
+    for cat in categories:
+        if db_cache["tpo"].get(cat) is None or db_cache["products"].get(cat) is None:
+            problems.append(f"{cat}: tpo DB 없음")
+            continue
+        for kind in ("style", "tpo"):
+            db = db_cache[kind].get(cat)
+            if db is None:
+                continue
+            n_rows = len(db["rows"]) if db["rows"] is not None else len(db["meta"])
+            if db["index"].ntotal != n_rows:
+                problems.append(f"{kind}/{cat}: index ntotal={db['index'].ntotal} != metadata rows={n_rows}")
+            if dim is not None and db["index"].d != dim:
+                problems.append(f"{kind}/{cat}: index dim={db['index'].d} != embedding dim={dim}")
+    if problems:
+        raise ValueError("; ".join(problems))
+
+# 페르소나 필터: 스트릿 스타일 제외 대상
+STREET_EXCLUDED_PERSONAS = ("pme", "promi")
+
+def build_attribute_index(metas):
+    """
+    속성값 → row 비트셋 역색인 + 페르소나별 기본 비트셋 (로드 시 1회)
+    페르소나 비트셋: 성별 + 페르소나 제외 조건을 통과하는 row
+    """
+    if not isinstance(metas, MetadataStore):
+        metas = MetadataStore.from_records(metas)
+
+    attr_index = AttributeIndex(metas)
+    for persona in PERSONA_MOOD:
+        attr_index.persona_bits[persona] = _persona_bits(attr_index, persona, GENDER_MAP[persona])
+    return attr_index
+
+def _persona_bits(attr_index, persona, user_gender):
+    bits = attr_index.all.copy()
+
+    # gender filter
+    if user_gender == "남자":
+        bits &= ~attr_index.bitset("gender", "여")
+    if user_gender == "여자":
+        bits &= ~attr_index.bitset("gender", "남")
+
+    # persona filter
+    if persona in STREET_EXCLUDED_PERSONAS:
+        bits &= ~attr_index.bitset("style", "스트릿")
+    return bits
+
+def partition_key(persona, user_gender):
+    # 페르소나 기본 필터(_persona_bits)는 성별 + 스트릿 제외 여부로만 결정됨
+    return (user_gender, persona in STREET_EXCLUDED_PERSONAS)
+
+def build_partitions(index, attr_index, rows=None):
+    """
+    성별 × 스트릿 제외 여부별 flat 서브 인덱스 (로드 시 1회, FAISS_PARTITIONS=1일 때만)
+    다른 성별 / 제외 스타일 row는 서브 인덱스에 아예 없으므로 검색 때 스캔하지 않음
+    메모리: 공용 row가 여러 파티션에 들어가 파티션 합계가 원본 row 수의 약 1.6~2배이고,
+    mmap된 원본과 달리 heap에 복사됨 (hot reload 중에는 버전마다 한 벌씩)
+    반환: {partition_key: {"index": IndexFlat, "row_ids": 원래 인덱스 row 번호}}
+    (flat 인덱스가 아니면 {} → 전체 인덱스 + IDSelector로 검색)
+    """
+    if not FAISS_PARTITIONS or not isinstance(index, faiss.IndexFlat):
+        return {}
+
+    xb = index.reconstruct_n(0, index.ntotal)
+    partitions = {}
+    for persona in PERSONA_MOOD:
+        key = partition_key(persona, GENDER_MAP[persona])
+        if key in partitions:
+            continue
+        bits = _row_bitset(attr_index, attr_index.persona_bits[persona], rows)
+        row_ids = np.flatnonzero(np.unpackbits(bits, count=index.ntotal, bitorder="little"))
+        sub_index = faiss.IndexFlat(index.d, index.metric_type)
+        sub_index.add(xb[row_ids])
+        partitions[key] = {"index": sub_index, "row_ids": row_ids}
+    return partitions
+
+def build_eligibility_bitset(attr_index, persona, user_gender, negatives, hard_constraints=None):
+    """성별/페르소나/hard constraints/negatives를 모두 만족하는 row 비트셋 (AND / OR 조합)"""
+    if hard_constraints is None:
+        hard_constraints = init_hard_constraints()
+
+    if user_gender == GENDER_MAP.get(persona):
+        bits = attr_index.persona_bits[persona].copy()
+    else:
+        bits = _persona_bits(attr_index, persona, user_gender)
+
+    # ---------- sub category ----------
+    if hard_constraints["forced_sub_categories"]:
+        bits &= attr_index.bitset("sub_cat_name", hard_constraints["forced_sub_categories"][-1]) # 여러 개가 있을 수 있는데 마지막 걸로
+
+    # ---------- color ----------
+    if hard_constraints["preferred_colors"]:
+        # preferred colors(+ 유사 색상)의 요소가 주요 색상에 포함된 row
+        bits &= attr_index.contains_any("main_color", hard_constraints["preferred_colors"])
+
+    # ---------- fit / pattern / texture ----------
+    if hard_constraints["preferred_fits"]:
+        bits &= attr_index.bitset("fit", hard_constraints["preferred_fits"][-1])
+    if hard_constraints["preferred_patterns"]:
+        bits &= attr_index.bitset("pattern", hard_constraints["preferred_patterns"][-1])
+    if hard_constraints["preferred_textures"]:
+        bits &= attr_index.bitset("texture", hard_constraints["preferred_textures"][-1])
+
+    # negative filter
+    bits &= ~attr_index.any_of("fit", negatives.get("fit", []))
+    bits &= ~attr_index.any_of("pattern", negatives.get("pattern", []))
+    # price_threshold가 없으면 기본 상한 적용 (명시적으로 None이면 상한 없음)
+    price_threshold = negatives.get("price_threshold", DEFAULT_PRICE_THRESHOLD)
+    if price_threshold is not None:
+        bits &= attr_index.price_at_most(price_threshold)
+
+    return bits
+
+def _row_bitset(attr_index, bits, rows=None):
+    """상품(pid) 비트셋 → 인덱스 row 비트셋 (rows: row → pid 배열, None이면 그대로)"""
+    if rows is None:
+        return bits
+    return attr_index.from_mask(attr_index.to_mask(bits)[rows])
+
+def count_eligible(db_cache, category, persona, user_gender, negatives, hard_constraints=None):
+    """
+    벡터 검색 전에 style / tpo DB 각각의 eligible 아이템 수를 정확히 계산
+    반환: {"style": int, "tpo": int} (style DB가 없으면 0)
+    """
+    counts = {}
+    for kind in ("style", "tpo"):
+        db = db_cache[kind][category]
+        if db is None:
+            counts[kind] = 0
+            continue
+        bits = build_eligibility_bitset(db["attr_index"], persona, user_gender, negatives, hard_constraints)
+        counts[kind] = AttributeIndex.count(_row_bitset(db["attr_index"], bits, db.get("rows")))
+    return counts
+
 # ===============================
 # 2. Input
 # ===============================
@@ -205,14 +585,86 @@ def get_tpo():
 # 3. OpenAI API: parse_tpo, judge_conflict, rerank_with_llm, generate_reason, update_query
 # =============================================================================================
 
+# 응답을 기다리는 최대 시간(초): timeout으로 버려진 호출이 스레드 / 커넥션을 오래 점유하지 않도록
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "60"))
+
 def get_client():
     # 환경변수 OPENAI_API_KEY 사용
-    return OpenAI(api_key=os.environ["OPENAI_API_KEY"])
+    return OpenAI(api_key=os.environ["OPENAI_API_KEY"], timeout=OPENAI_TIMEOUT)
 
-def parse_tpo(tpo_text: str):
-    print("👉 Parsing the tpo...")
-    client = OpenAI(api_key=os.environ["OPENAI_API_KEY"])
-    res = client.chat.completions.create(
+_async_client = None
+
+def get_async_client():
+    # 이벤트 루프에서 여러 요청이 커넥션 풀을 공유하도록 하나만 생성
+    global _async_client
+    if _async_client is None:
+        _async_client = AsyncOpenAI(api_key=os.environ["OPENAI_API_KEY"], timeout=OPENAI_TIMEOUT)
+    return _async_client
+
+def chat_completion(site: str, **request):
+    """
+    chat.completions.create + SQLite 응답 캐시 (llm_cache.py)
+    site: 호출 지점 이름 (캐시 key / TTL / hit 통계 단위)
+    반환: 응답 message content 문자열
+    """
+    start = time.perf_counter()
+    key = llm_cache.make_key(site, request)
+    content = llm_cache.get(site, key)
+    if content is not None:
+        llm_cache.record(site, True, time.perf_counter() - start)
+        return content
+
+    res = get_client().chat.completions.create(**request)
+    content = res.choices[0].message.content
+    llm_cache.put(site, key, content)
+    llm_cache.record(site, False, time.perf_counter() - start)
+    return content
+
+async def chat_completion_async(site: str, **request):
+    """
+    chat_completion의 AsyncOpenAI 버전 (캐시 공유)
+    SQLite 조회 / 저장(WAL commit + 주기적 eviction)은 이벤트 루프를 막지 않도록 스레드에서 실행
+    """
+    start = time.perf_counter()
+    key = llm_cache.make_key(site, request)
+    content = await asyncio.to_thread(llm_cache.get, site, key)
+    if content is not None:
+        llm_cache.record(site, True, time.perf_counter() - start)
+        return content
+
+    res = await get_async_client().chat.completions.create(**request)
+    content = res.choices[0].message.content
+    await asyncio.to_thread(llm_cache.put, site, key, content)
+    llm_cache.record(site, False, time.perf_counter() - start)
+    return content
+
+async def chat_completion_stream(site: str, **request):
+    """
+    chat_completion의 스트리밍 버전: 응답 텍스트 조각(delta)을 순서대로 yield
+    캐시 key는 stream 여부와 무관 (cache hit이면 전체 응답을 한 번에 yield, 끝까지 받은 응답만 저장)
+    캐시 조회 / 저장은 chat_completion_async처럼 스레드에서 실행
+    """
+    start = time.perf_counter()
+    key = llm_cache.make_key(site, request)
+    content = await asyncio.to_thread(llm_cache.get, site, key)
+    if content is not None:
+        llm_cache.record(site, True, time.perf_counter() - start)
+        yield content
+        return
+
+    stream = await get_async_client().chat.completions.create(stream=True, **request)
+    parts = []
+    async for chunk in stream:
+        delta = chunk.choices[0].delta.content if chunk.choices else None
+        if delta:
+            parts.append(delta)
+            yield delta
+    content = "".join(parts)
+    await asyncio.to_thread(llm_cache.put, site, key, content)
+    llm_cache.record(site, False, time.perf_counter() - start)
+
+def _parse_tpo_request(tpo_text: str):
+    return dict(
         model="gpt-4o",
         temperature=0,
         response_format={"type": "json_object"},
@@ -250,20 +702,25 @@ def parse_tpo(tpo_text: str):
             {"role": "user", "content": tpo_text},
         ]
     )
-    parsed = json.loads(res.choices[0].message.content)
-    return parsed.get("parsed_keywords", [])
 
-def judge_conflict(persona: str, parsed_tpo: list) -> bool:
-    print("👉 Judging tpo and style conflict...")
-    client = get_client()
+def parse_tpo(tpo_text: str):
+    print("👉 Parsing the tpo...")
+    content = chat_completion("parse_tpo", **_parse_tpo_request(tpo_text))
+    return json.loads(content).get("parsed_keywords", [])
+
+async def parse_tpo_async(tpo_text: str):
+    print("👉 Parsing the tpo...")
+    content = await chat_completion_async("parse_tpo", **_parse_tpo_request(tpo_text))
+    return json.loads(content).get("parsed_keywords", [])
 
+def _judge_conflict_request(persona: str, parsed_tpo: list):
     payload = {
         "persona": persona,
         "persona_mood": PERSONA_MOOD[persona],
         "tpo": parsed_tpo
     }
 
-    res = client.chat.completions.create(
+    return dict(
         model="gpt-4o",
         temperature=0,
         response_format={"type":"json_object"},
@@ -273,20 +730,17 @@ def judge_conflict(persona: str, parsed_tpo: list) -> bool:
         ]
     )
 
-    obj = json.loads(res.choices[0].message.content)
-    return bool(obj["conflict"])
+def judge_conflict(persona: str, parsed_tpo: list) -> bool:
+    print("👉 Judging tpo and style conflict...")
+    content = chat_completion("judge_conflict", **_judge_conflict_request(persona, parsed_tpo))
+    return bool(json.loads(content)["conflict"])
 
-def rerank_with_llm(
-    persona,
-    parsed_tpo,
-    conflict,
-    fused_candidates,
-    selected_items,
-    topk=3
-):
-    print("👉 Items are reranking with llm...")
-    client = get_client()
+async def judge_conflict_async(persona: str, parsed_tpo: list) -> bool:
+    print("👉 Judging tpo and style conflict...")
+    content = await chat_completion_async("judge_conflict", **_judge_conflict_request(persona, parsed_tpo))
+    return bool(json.loads(content)["conflict"])
 
+def _rerank_payload(persona, parsed_tpo, conflict, fused_candidates, selected_items):
     def summarize(item):
         return {
             "product_id": str(item.get("product_id")),
@@ -301,7 +755,7 @@ def rerank_with_llm(
             "img_url": item.get("img_url")
         }
 
-    payload = {
+    return {
         "persona": persona,
         "persona_mood": PERSONA_MOOD[persona],
         "parsed_tpo": parsed_tpo,
@@ -310,7 +764,19 @@ def rerank_with_llm(
         "candidates": [summarize(x) for x in fused_candidates]
     }
 
-    res = client.chat.completions.create(
+def rerank_with_llm(
+    persona,
+    parsed_tpo,
+    conflict,
+    fused_candidates,
+    selected_items,
+    topk=3
+):
+    print("👉 Items are reranking with llm...")
+    payload = _rerank_payload(persona, parsed_tpo, conflict, fused_candidates, selected_items)
+
+    content = chat_completion(
+        "rerank",
         model="gpt-4o",
         temperature=0.2,
         response_format={"type": "json_object"},
@@ -320,18 +786,151 @@ def rerank_with_llm(
         ]
     )
 
-    obj = json.loads(res.choices[0].message.content)
+    obj = json.loads(content)
     return obj["top_items"][:topk]
 
+# -------------------------------
+# 리랭킹 모드
+# - "two_stage": rerank_with_llm → 아이템별 generate_reason (기본)
+# - "fused": rerank_and_explain 1회 호출로 순서 + 이유 (실패 시 two_stage로 fallback)
+# -------------------------------
+RERANK_MODE = os.getenv("RERANK_MODE", "two_stage")
+
+RERANK_EXPLAIN_SCHEMA = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "rerank_explain",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "top_items": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "product_id": {"type": "string"},
+                            "reason": {"type": "string"}
+                        },
+                        "required": ["product_id", "reason"],
+                        "additionalProperties": False
+                    }
+                }
+            },
+            "required": ["top_items"],
+            "additionalProperties": False
+        }
+    }
+}
+
+def rerank_and_explain(
+    persona,
+    parsed_tpo,
+    conflict,
+    fused_candidates,
+    selected_items,
+    topk=3
+):
+    """
+    리랭킹 + 추천 이유를 한 번의 호출로
+    반환: [(product_id, reason), ...] (리랭킹 순서) / 호출·파싱 실패 시 None
+    """
+    print("👉 Items are reranking and explaining with llm...")
+    payload = _rerank_payload(persona, parsed_tpo, conflict, fused_candidates, selected_items)
+
+    try:
+        content = chat_completion(
+            "rerank_explain",
+            model="gpt-4o",
+            temperature=0.2,
+            response_format=RERANK_EXPLAIN_SCHEMA,
+            messages=[
+                {"role": "system", "content": HARMONY_RERANK_EXPLAIN_PROMPT},
+                {"role": "user", "content": json.dumps(payload, ensure_ascii=False)}
+            ]
+        )
+        top_items = json.loads(content)["top_items"][:topk]
+        return [(str(x["product_id"]), (x.get("reason") or "").strip()) for x in top_items]
+    except Exception as e:
+        print(f"⚠️ rerank_and_explain 실패: {e!r} → 2단계(rerank + reason) 경로 사용")
+        return None
+
+# -------------------------------
+# TPO 분석 모드
+# - "pipeline": refine_tpo_text / parse_tpo / judge_conflict 3회 호출 (기본)
+# - "combined": analyze_tpo 1회 structured output 호출
+# -------------------------------
+TPO_ANALYSIS_MODE = os.getenv("TPO_ANALYSIS_MODE", "pipeline")
+
+TPO_ANALYSIS_SCHEMA = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "tpo_analysis",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "refined_tpo": {"type": "string"},
+                "parsed_keywords": {"type": "array", "items": {"type": "string"}},
+                "conflict": {"type": "boolean"}
+            },
+            "required": ["refined_tpo", "parsed_keywords", "conflict"],
+            "additionalProperties": False
+        }
+    }
+}
+
+def _analyze_tpo_request(persona: str, tpo_raw: str):
+    def user_turn(p, tpo):
+        return json.dumps({"persona": p, "persona_mood": PERSONA_MOOD[p], "tpo": tpo}, ensure_ascii=False)
+
+    return dict(
+        model="gpt-4o",
+        temperature=0,
+        response_format=TPO_ANALYSIS_SCHEMA,
+        messages=[
+            {"role": "system", "content": TPO_ANALYZE_PROMPT},
+            # shot 1
+            {"role": "user", "content": user_turn("pme", "1월에 회사 면접을 보러 가서 단정하고 깔끔한 면접룩을 추천받고 싶어.")},
+            {"role": "assistant", "content": json.dumps(
+                {"refined_tpo": "회사 면접룩", "parsed_keywords": ["1월에 회사 면접", "단정하고 깔끔한 면접룩"], "conflict": False},
+                ensure_ascii=False
+            )},
+            # shot 2
+            {"role": "user", "content": user_turn("moyon", "결혼식 하객으로 가는데 깔끔하게 입고 싶어")},
+            {"role": "assistant", "content": json.dumps(
+                {"refined_tpo": "결혼식 하객룩", "parsed_keywords": ["결혼식 하객", "깔끔한 스타일"], "conflict": True},
+                ensure_ascii=False
+            )},
+            {"role": "user", "content": user_turn(persona, tpo_raw)},
+        ]
+    )
+
+def _parse_tpo_analysis(content: str):
+    obj = json.loads(content)
+    return {
+        "refined_tpo": obj["refined_tpo"].strip(),
+        "parsed_keywords": obj.get("parsed_keywords", []),
+        "conflict": bool(obj["conflict"])
+    }
+
+def analyze_tpo(persona: str, tpo_raw: str):
+    """refine + parse + conflict 판단을 한 번의 호출로 → {refined_tpo, parsed_keywords, conflict}"""
+    print("👉 Analyzing TPO (refine + parse + conflict)...")
+    content = chat_completion("analyze_tpo", **_analyze_tpo_request(persona, tpo_raw))
+    return _parse_tpo_analysis(content)
+
+async def analyze_tpo_async(persona: str, tpo_raw: str):
+    print("👉 Analyzing TPO (refine + parse + conflict)...")
+    content = await chat_completion_async("analyze_tpo", **_analyze_tpo_request(persona, tpo_raw))
+    return _parse_tpo_analysis(content)
+
 def build_reason_query(persona, parsed_tpo):
     tpo_text = ", ".join(parsed_tpo)
     persona_text = ", ".join(PERSONA_MOOD[persona])
     return f"추천상황(TPO): {tpo_text}\n페르소나 스타일: {persona_text}"
 
-def generate_reason(reason_query: str, selected_context_text: str, item_desc: str):
-    print("👉 Reason for recommendation is generating...")
-    client = get_client()
-
+def _generate_reason_request(reason_query: str, selected_context_text: str, item_desc: str):
     reason_input = f"""
 [TPO & PERSONA]
 {reason_query}
@@ -343,7 +942,7 @@ def generate_reason(reason_query: str, selected_context_text: str, item_desc: st
 {item_desc}
 """.strip()
 
-    response = client.chat.completions.create(
+    return dict(
         model="gpt-4o",
         temperature=0.0,
         messages=[
@@ -364,12 +963,82 @@ def generate_reason(reason_query: str, selected_context_text: str, item_desc: st
             {"role":"user", "content": reason_input},
         ]
     )
-    return response.choices[0].message.content.strip()
 
-def refine_tpo_text(tpo_raw: str):
-    print("👉 Refining TPO text...")
-    client = get_client()
+def generate_reason(reason_query: str, selected_context_text: str, item_desc: str):
+    print("👉 Reason for recommendation is generating...")
+    content = chat_completion(
+        "generate_reason", **_generate_reason_request(reason_query, selected_context_text, item_desc)
+    )
+    return content.strip()
+
+async def generate_reason_stream(reason_query: str, selected_context_text: str, item_desc: str):
+    """generate_reason의 스트리밍 버전: 추천 이유 텍스트 조각을 순서대로 yield"""
+    print("👉 Reason for recommendation is streaming...")
+    async for delta in chat_completion_stream(
+        "generate_reason", **_generate_reason_request(reason_query, selected_context_text, item_desc)
+    ):
+        yield delta
+
+# 추천 이유 병렬 생성: 요청당 동시 호출 수 / 전체 대기 시간(초) 상한
+REASON_CONCURRENCY = int(os.getenv("REASON_CONCURRENCY", "3"))
+REASON_TIMEOUT = float(os.getenv("REASON_TIMEOUT", "20"))
+
+def item_description(item):
+    return f"{item.get('main_cat_name')}({item.get('sub_cat_name')}): {item.get('description')}"
+
+# 추천 이유 생성용 공용 스레드 풀 (서버 전체 동시 호출 상한)
+_REASON_POOL = ThreadPoolExecutor(max_workers=int(os.getenv("REASON_POOL_WORKERS", "8")), thread_name_prefix="reason")
+
+def fallback_reason(item, error=None):
+    """
+    LLM 이유 생성 실패 / timeout 시 메타데이터 기반 기본 문구
+    사용 횟수는 /admin/llm_cache의 generate_reason.fallbacks로 집계
+    """
+    print(f"⚠️ 추천 이유 생성 실패 ({item.get('product_id')}): {error!r} → 기본 문구 사용")
+    llm_cache.record_fallback("generate_reason")
+    parts = [p for p in (main_color_of(item.get("color")), item.get("fit"), item.get("sub_cat_name")) if p]
+    return f"{' '.join(parts)} 아이템으로, 지금 상황과 스타일에 무난하게 어울리는 선택이에요."
+
+def generate_reasons(reason_query: str, selected_context_text: str, items: list,
+                     concurrency=REASON_CONCURRENCY, timeout=REASON_TIMEOUT):
+    """
+    items의 추천 이유를 공용 풀에서 동시에 생성 (요청당 최대 concurrency개 호출)
+    반환: items와 같은 순서의 reason 리스트
+    - 실패하거나 timeout 안에 끝나지 않은 아이템은 fallback_reason (다른 아이템은 그대로)
+    - 시작 전인 호출은 취소, 이미 시작된 호출은 OPENAI_TIMEOUT까지 풀 워커 1개를 점유 (완료되면 LLM 캐시에 저장)
+    """
+    if not items:
+        return []
 
+    deadline = time.perf_counter() + timeout
+    slots = threading.BoundedSemaphore(max(1, concurrency))
+
+    def run(item):
+        try:
+            return generate_reason(reason_query, selected_context_text, item_description(item))
+        finally:
+            slots.release()
+
+    futures = []
+    for item in items:
+        if slots.acquire(timeout=max(0.0, deadline - time.perf_counter())):
+            futures.append(_REASON_POOL.submit(run, item))
+        else:
+            futures.append(None)
+
+    reasons = []
+    for item, future in zip(items, futures):
+        if future is None:
+            reasons.append(fallback_reason(item, TimeoutError("no free reason slot before deadline")))
+            continue
+        try:
+            reasons.append(future.result(timeout=max(0.0, deadline - time.perf_counter())))
+        except Exception as e:
+            future.cancel()
+            reasons.append(fallback_reason(item, e))
+    return reasons
+
+def _refine_tpo_request(tpo_raw: str):
     # TPO 추출을 위한 시스템 프롬프트 (별도 정의 필요)
     TPO_REFINE_PROMPT = """
 당신은 사용자의 요청에서 핵심 TPO(상황, 장소, 목적)만 추출하여 짧고 간결한 키워드로 변환하는 전문가입니다.
@@ -378,7 +1047,7 @@ def refine_tpo_text(tpo_raw: str):
 - 출력은 반드시 정제된 텍스트만 반환하세요.
 """.strip()
 
-    response = client.chat.completions.create(
+    return dict(
         model="gpt-4o",
         temperature=0.0,  # 일관성을 위해 0으로 설정
         messages=[
@@ -394,16 +1063,25 @@ def refine_tpo_text(tpo_raw: str):
             {"role": "user", "content": tpo_raw},
         ]
     )
-    return response.choices[0].message.content.strip()
+
+def refine_tpo_text(tpo_raw: str):
+    print("👉 Refining TPO text...")
+    content = chat_completion("refine_tpo", **_refine_tpo_request(tpo_raw))
+    return content.strip()
+
+async def refine_tpo_text_async(tpo_raw: str):
+    print("👉 Refining TPO text...")
+    content = await chat_completion_async("refine_tpo", **_refine_tpo_request(tpo_raw))
+    return content.strip()
 
 def update_query_with_feedback(prev_query: str, feedback_text: str):
     print("👉 Query is being updated with feedback...")
-    client = get_client()
     payload = {
         "PERSONA_SUMMARY": prev_query,   # ✅ 프롬프트 문구에 맞춤
         "user_feedback": feedback_text   # ✅ 프롬프트 문구에 맞춤
     }
-    res = client.chat.completions.create(
+    content = chat_completion(
+        "update_query",
         model="gpt-4o",
         temperature=0,
         response_format={"type":"json_object"},
@@ -412,92 +1090,216 @@ def update_query_with_feedback(prev_query: str, feedback_text: str):
             {"role":"user", "content": json.dumps(payload, ensure_ascii=False)}
         ]
     )
-    return json.loads(res.choices[0].message.content)["updated_query"]
+    return json.loads(content)["updated_query"]
 
 # -------------------------------
 # 4. Retrieve
 # -------------------------------
 
-def retrieve_from_faiss(persona, model, index, metas, query_text, negatives, user_gender, hard_constraints=None, topk=5):
-    # dense search (faiss)
-    qvec = embed_text(query_text, model).reshape(1, -1)
-    faiss.normalize_L2(qvec)
-
-    search_k = min(len(metas), topk * 30) # 10개
-    D, I = index.search(qvec, search_k)
-    print(f"DEBUG: {len(I[0])} items found in FAISS") # 1. 검색된 개수 확인
-
-    results = []
-    for rank_i, idx in enumerate(I[0]):
-        if idx < 0:
-            continue
-        meta = metas[idx].copy()
-
-        # gender filter
-        if user_gender == "남자" and meta.get("gender") == "여":
-            continue
-        if user_gender == "여자" and meta.get("gender") == "남":
-            continue
-
-        # persona filter
-        if persona == "pme" or persona == "promi":
-            if meta.get("style") == "스트릿":
-                continue
-            
-        # ---------- sub category ----------
-        if hard_constraints["forced_sub_categories"]:
-            sub_cat = meta.get("sub_cat_name")
-            if sub_cat != hard_constraints["forced_sub_categories"][-1]: # 여러 개가 있을 수 있는데 마지막 걸로 
-                continue
-        
-        # ---------- color ----------
-        if hard_constraints["preferred_colors"]:
-            color = meta.get("color")
-            main_color = color.split(", ")[0] # 주요 색상
-            
-            if not any(pref in main_color for pref in hard_constraints['preferred_colors']): # preferred colors의 요소가 color에 포함돼 있지 않으면 continue
-                continue
-
-        # ---------- fit ----------
-        if hard_constraints["preferred_fits"]:
-            fit = meta.get("fit")
-            if fit != hard_constraints["preferred_fits"][-1]: # 여러 개가 있을 수 있는데 마지막 걸로 
-                continue
+# style / tpo 인덱스 동시 검색용 스레드 풀
+_SEARCH_POOL = ThreadPoolExecutor(max_workers=int(os.getenv("FAISS_SEARCH_WORKERS", "4")), thread_name_prefix="faiss-search")
+
+# 검색 모드
+# - "selector": 필터를 IDSelector로 pushdown (기본)
+# - "adaptive": 필터 없이 검색 후 마스크로 거르고, topk가 안 채워지면 k를 기하급수적으로 늘려 재검색
+FAISS_SEARCH_MODE = os.getenv("FAISS_SEARCH_MODE", "selector")
+ADAPTIVE_INITIAL_K_FACTOR = int(os.getenv("ADAPTIVE_INITIAL_K_FACTOR", "2"))  # 시작 k = topk * factor
+ADAPTIVE_GROWTH = int(os.getenv("ADAPTIVE_GROWTH", "4"))  # 단계마다 k *= growth
+# ANN 인덱스(ivf / hnsw / sq8 / pq)에서 eligible row가 이 수 이하면 그래프 / 클러스터 탐색 대신
+# 원본 flat 벡터로 eligible row만 exact 스코어링 (조건이 빡빡하면 ANN 탐색이 후보를 놓침)
+FAISS_EXACT_SCAN_MAX = int(os.getenv("FAISS_EXACT_SCAN_MAX", "1024"))
+
+
+class SearchStats:
+    """FAISS 검색 지표: 쿼리별 최종 검색 깊이(k), 인덱스 소진/결과 부족 횟수"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.depth_hist = Histogram([5, 10, 20, 40, 80, 160, 320, 640, 1280])
+        self.rounds_hist = Histogram([1, 2, 3, 4, 5])
+        self.queries = 0
+        self.no_eligible = 0
+        self.exhausted = 0
+        self.short_results = 0
+        self.partitioned = 0  # 서브 인덱스로 검색한 쿼리
+        self.unfiltered = 0   # 파티션 전체가 eligible이라 선택자 없이 스캔한 쿼리
+        self.exact_scans = 0  # ANN 인덱스 대신 eligible row만 exact 스코어링한 쿼리
+
+    def record(self, depth, rounds, n_results, topk, exhausted):
+        with self._lock:
+            self.queries += 1
+            self.depth_hist.observe(depth)
+            self.rounds_hist.observe(rounds)
+            if exhausted:
+                self.exhausted += 1
+            if n_results < topk:
+                self.short_results += 1
+
+    def record_scope(self, partitioned, unfiltered, exact=False):
+        with self._lock:
+            self.partitioned += int(partitioned)
+            self.unfiltered += int(unfiltered)
+            self.exact_scans += int(exact)
+
+    def record_no_eligible(self):
+        with self._lock:
+            self.queries += 1
+            self.no_eligible += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "mode": FAISS_SEARCH_MODE,
+                "variant": FAISS_INDEX_VARIANT,
+                "queries": self.queries,
+                "no_eligible": self.no_eligible,
+                "exhausted": self.exhausted,
+                "short_results": self.short_results,
+                "partitioned": self.partitioned,
+                "unfiltered": self.unfiltered,
+                "exact_scans": self.exact_scans,
+                "depth": self.depth_hist.snapshot(),
+                "rounds": self.rounds_hist.snapshot()
+            }
+
+
+search_stats = SearchStats()
+
+def faiss_search_params(index, bits=None, k=0, nprobe=None, ef_search=None, n_eligible=None):
+    """
+    인덱스 타입별 SearchParameters (+ IDSelectorBitmap)
+    - IVF: nprobe (FAISS_NPROBE)
+    - HNSW: efSearch (FAISS_EF_SEARCH, 최소 k, 선택자가 있으면 ntotal / n_eligible 배로 확장)
+    - IndexRefine(압축 + flat 재스코어링): 1차 검색 k * FAISS_RESCORE_K_FACTOR
+    """
+    if isinstance(index, faiss.IndexRefine):
+        # 선택자 / nprobe / efSearch는 1차 검색(압축 인덱스)에 적용
+        base_params = faiss_search_params(
+            faiss.downcast_index(index.base_index), bits, k * FAISS_RESCORE_K_FACTOR, nprobe, ef_search, n_eligible
+        )
+        return faiss.IndexRefineSearchParameters(k_factor=FAISS_RESCORE_K_FACTOR, base_index_params=base_params)
+
+    kwargs = {}
+    if bits is not None:
+        kwargs["sel"] = faiss.IDSelectorBitmap(bits)
+
+    if isinstance(index, faiss.IndexHNSW):
+        ef_search = max(ef_search or FAISS_EF_SEARCH, k)
+        if bits is not None and n_eligible:
+            # 그래프 탐색 중 선택자 밖 노드는 결과에 못 들어가므로, eligible 비율만큼 후보 리스트를 늘려야 k개가 채워짐
+            ef_search = max(k, min(index.ntotal, -(-ef_search * index.ntotal // n_eligible)))
+        return faiss.SearchParametersHNSW(efSearch=ef_search, **kwargs)
+    if faiss.try_extract_index_ivf(index) is not None:
+        return faiss.SearchParametersIVF(nprobe=nprobe or FAISS_NPROBE, **kwargs)
+    return faiss.SearchParameters(**kwargs)
+
+def _selector_search(index, qvec, bits, n_eligible, topk):
+    """조건을 만족하는 벡터만 스코어링 (역색인 비트셋을 그대로 IDSelectorBitmap으로 사용)"""
+    k = min(topk, n_eligible)
+    params = faiss_search_params(index, bits, k, n_eligible=n_eligible)
+    D, I = index.search(qvec, k, params=params)
+    keep = I[0] >= 0
+    search_stats.record(k, 1, int(keep.sum()), topk, exhausted=False)
+    return D[0][keep], I[0][keep]
+
+def _exact_search(vectors, qvec, bits, n_rows, topk):
+    """eligible row만 원본 flat 벡터(mmap)로 exact 스코어링 (eligible 수만큼만 내적)"""
+    ids = np.flatnonzero(np.unpackbits(bits, count=n_rows, bitorder="little"))
+    scores = vectors.reconstruct_batch(ids) @ qvec[0]
+    top = np.argsort(-scores, kind="stable")[:topk]
+    search_stats.record(len(ids), 1, len(top), topk, exhausted=False)
+    return scores[top], ids[top]
+
+def _adaptive_search(index, qvec, bits, topk):
+    """
+    iterative deepening: 작은 k로 시작해 topk개가 필터를 통과하거나
+    인덱스를 모두 볼 때까지 k를 기하급수적으로 늘림
+    """
+    n = index.ntotal
+    k = min(n, topk * ADAPTIVE_INITIAL_K_FACTOR)
+    rounds = 0
+    while True:
+        rounds += 1
+        D, I = index.search(qvec, k, params=faiss_search_params(index, k=k))
+        ids = I[0]
+        keep = ids >= 0
+        if bits is not None:
+            keep[keep] = AttributeIndex.contains(bits, ids[keep])
+        if keep.sum() >= topk or k >= n:
+            break
+        k = min(n, k * ADAPTIVE_GROWTH)
 
-        # ---------- pattern ----------
-        if hard_constraints["preferred_patterns"]:
-            pattern = meta.get("pattern")
-            if pattern != hard_constraints["preferred_patterns"][-1]: # 여러 개가 있을 수 있는데 마지막 걸로 
-                continue
+    hit_rows = np.flatnonzero(keep)[:topk]
+    search_stats.record(k, rounds, len(hit_rows), topk, exhausted=(k >= n and len(hit_rows) < topk))
+    return D[0][hit_rows], ids[hit_rows]
 
-        # ---------- texture ----------
-        if hard_constraints["preferred_textures"]:
-            texture = meta.get("texture")
-            if texture != hard_constraints["preferred_textures"][-1]: # 여러 개가 있을 수 있는데 마지막 걸로 
-                continue
+def retrieve_from_faiss(persona, model, index, metas, query_text, negatives, user_gender, hard_constraints=None, topk=5, query_vec=None, attr_index=None, rows=None, partitions=None, vectors=None):
+    """
+    rows: 인덱스 row → 상품 테이블 pid 배열 (None이면 row 번호 == pid)
+    partitions: build_partitions 결과 (있으면 세션 성별 / 페르소나의 서브 인덱스만 검색)
+    vectors: 원본 flat 벡터 (load_vector_source) - ANN 인덱스에서 eligible row가 적으면 exact 스캔에 사용
+    반환 아이템에는 상품 테이블의 dense id("pid")가 포함됨 (fuse / lookup 조인 키)
+    """
+    # dense search (faiss) - 미리 계산된 query_vec이 있으면 인코딩 생략
+    if query_vec is None:
+        query_vec = embed_text(query_text, model)
+    qvec = np.array(query_vec, dtype="float32").reshape(1, -1)
+    faiss.normalize_L2(qvec)
 
-        # negative filter
-        if meta.get("fit") in negatives["fit"]:
-            continue
-        if meta.get("pattern") in negatives["pattern"]:
-            continue
-        if meta.get("price_raw", 0) > negatives["price_threshold"]:
-            continue
+    # 필터 조건을 역색인 비트셋 연산으로 컴파일
+    if attr_index is None:
+        attr_index = build_attribute_index(metas)
+    bits = build_eligibility_bitset(attr_index, persona, user_gender, negatives, hard_constraints)
+    bits = _row_bitset(attr_index, bits, rows)
+    n_eligible = AttributeIndex.count(bits)
+    if n_eligible == 0:
+        search_stats.record_no_eligible()
+        print("DEBUG: 0 items are eligible")
+        return []
 
-        meta["score"] = float(D[0][rank_i])
+    # 서브 인덱스: 비트셋을 파티션 row 공간으로 옮기고, 파티션 전체가 eligible이면 선택자 없이 스캔
+    part = (partitions or {}).get(partition_key(persona, user_gender))
+    search_index = index
+    if part is not None:
+        search_index = part["index"]
+        mask = np.unpackbits(bits, count=index.ntotal, bitorder="little").astype(bool)[part["row_ids"]]
+        bits = None if n_eligible == len(mask) else np.packbits(mask, bitorder="little")
+    exact = (
+        part is None and vectors is not None and not isinstance(index, faiss.IndexFlat)
+        and n_eligible <= FAISS_EXACT_SCAN_MAX
+    )
+    search_stats.record_scope(part is not None, bits is None, exact)
+
+    if exact:
+        scores, ids = _exact_search(vectors, qvec, bits, index.ntotal, topk)
+    elif FAISS_SEARCH_MODE == "adaptive":
+        scores, ids = _adaptive_search(search_index, qvec, bits, topk)
+    else:
+        scores, ids = _selector_search(search_index, qvec, bits, n_eligible, topk)
+    if part is not None:
+        ids = part["row_ids"][ids]
+    print(f"DEBUG: {n_eligible} eligible items, {len(ids)} items found in FAISS")
+
+    # 최종 topk개만 dict로 변환
+    metas = attr_index.store
+    results = []
+    for score, idx in zip(scores, ids):
+        pid = int(idx if rows is None else rows[idx])
+        meta = metas.row(pid)
+        meta["pid"] = pid
+        meta["score"] = float(score)
         results.append(meta)
-        if len(results) >= topk:
-            break
-        
-    print(f"DEBUG: {len(results)} items are left") # 최종 검색된 개수 확인
-    return results
 
-def retrieve_candidates_by_category(persona, category, style_query, tpo_query, db_cache, model, negatives, user_gender, hard_constraints=None, topk=5):
-    print("👉 Retrieve items...")
+    return results
 
-    style_items = []
+def _retrieve_style_and_tpo(persona, category, style_query, tpo_query, db_cache, model, negatives, user_gender, hard_constraints, topk, style_vec, tpo_vec):
+    """
+    style / tpo 인덱스 검색을 동시에 실행
+    (faiss index.search는 GIL을 놓기 때문에 두 스캔이 겹쳐서 실행됨)
+    """
+    style_future = None
     if db_cache["style"][category] is not None:
-        style_items = retrieve_from_faiss(
+        style_future = _SEARCH_POOL.submit(
+            retrieve_from_faiss,
             persona,
             model,
             db_cache["style"][category]["index"],
@@ -506,7 +1308,12 @@ def retrieve_candidates_by_category(persona, category, style_query, tpo_query, d
             negatives,
             user_gender,
             hard_constraints,
-            topk
+            topk,
+            query_vec=style_vec,
+            attr_index=db_cache["style"][category]["attr_index"],
+            rows=db_cache["style"][category]["rows"],
+            partitions=db_cache["style"][category].get("partitions"),
+            vectors=db_cache["style"][category].get("vectors")
         )
 
     tpo_items = retrieve_from_faiss(
@@ -518,11 +1325,56 @@ def retrieve_candidates_by_category(persona, category, style_query, tpo_query, d
         negatives,
         user_gender,
         hard_constraints,
-        topk
+        topk,
+        query_vec=tpo_vec,
+        attr_index=db_cache["tpo"][category]["attr_index"],
+        rows=db_cache["tpo"][category]["rows"],
+        partitions=db_cache["tpo"][category].get("partitions"),
+        vectors=db_cache["tpo"][category].get("vectors")
     )
 
+    style_items = style_future.result() if style_future is not None else []
     return style_items, tpo_items
 
+def retrieve_candidates_by_category(persona, category, style_query, tpo_query, db_cache, model, negatives, user_gender, hard_constraints=None, topk=5, style_vec=None):
+    """style_vec: 시작 시 계산해 둔 페르소나 스타일 벡터 (있으면 style 쿼리는 모델 호출 없음)"""
+    print("👉 Retrieve items...")
+
+    return _retrieve_style_and_tpo(
+        persona, category, style_query, tpo_query, db_cache, model,
+        negatives, user_gender, hard_constraints, topk,
+        style_vec=style_vec, tpo_vec=None
+    )
+
+def retrieve_candidates_by_category_batched(persona, category, style_query, tpo_query, db_cache, model, negatives, user_gender, hard_constraints=None, topk=5, style_vec=None, tpo_vec=None):
+    """
+    retrieve_candidates_by_category의 배치 버전
+    style/tpo 쿼리를 한 번의 encode 호출로 인코딩한 뒤 각 row를 두 검색에 전달
+    (style_vec / tpo_vec이 미리 주어지면 해당 쿼리는 인코딩 생략)
+    """
+    print("👉 Retrieve items (batched)...")
+
+    has_style_db = db_cache["style"][category] is not None
+    need_style = has_style_db and style_vec is None
+    queries = []
+    if need_style:
+        queries.append(style_query)
+    if tpo_vec is None:
+        queries.append(tpo_query)
+
+    if queries:
+        vecs = embed_texts(queries, model)
+        if tpo_vec is None:
+            tpo_vec = vecs[-1]
+        if need_style:
+            style_vec = vecs[0]
+
+    return _retrieve_style_and_tpo(
+        persona, category, style_query, tpo_query, db_cache, model,
+        negatives, user_gender, hard_constraints, topk,
+        style_vec=style_vec, tpo_vec=tpo_vec
+    )
+
 def print_candidates(title, items, limit=5):
     print(f"\n--- {title} (n={len(items)}) ---")
     for i, x in enumerate(items[:limit], 1):
@@ -548,17 +1400,22 @@ def print_results(i, item, reason):
     print(f"description={item.get('description')}")
     print(f"👉 이유: {reason}")
 
+def _join_key(item):
+    # 상품 테이블 dense id (없으면 product_id 문자열)
+    pid = item.get("pid")
+    return pid if pid is not None else str(item["product_id"])
+
 def fuse_candidates(style_items, tpo_items, conflict, topk=5):
     merged = {}
 
-    # 1) score 수집 (item 단위로)
+    # 1) score 수집 (item 단위로, 상품 테이블 pid로 조인)
     for item in style_items:
-        pid = str(item["product_id"])
+        pid = _join_key(item)
         merged.setdefault(pid, {"item": item, "style_sim": 0.0, "tpo_sim": 0.0})
         merged[pid]["style_sim"] = item["score"] # normalize + IndexFlatP이므로 D는 거리가 아니라 코사인 유사도
 
     for item in tpo_items:
-        pid = str(item["product_id"])
+        pid = _join_key(item)
         merged.setdefault(pid, {"item": item, "style_sim": 0.0, "tpo_sim": 0.0})
         merged[pid]["tpo_sim"] = item["score"]
 
@@ -582,10 +1439,11 @@ def fuse_candidates(style_items, tpo_items, conflict, topk=5):
     # 4) 가중치 (conflict-aware)
     alpha, beta = (0.0, 1.0) if conflict else (0.5, 0.5)
 
-    # 5) fused score 계산
+    # 5) fused score 계산 (응답의 fused_score로도 노출)
     fused = []
     for (pid, v), s, t in zip(merged.items(), style_norm, tpo_norm):
         fused_score = alpha * s + beta * t
+        v["item"]["fused_score"] = float(fused_score)
         fused.append((fused_score, v["item"]))
 
     fused.sort(key=lambda x: x[0], reverse=True)
@@ -594,6 +1452,68 @@ def fuse_candidates(style_items, tpo_items, conflict, topk=5):
     return [item for _, item in fused[:topk]]
 
 
+# 퓨전 모드
+# - "legacy": 인덱스별 top-5, 한쪽에서만 검색된 아이템은 반대쪽 유사도 0 (fuse_candidates, 기본)
+# - "exact": 인덱스별 FUSION_POOL_SIZE개 후보 합집합 전체에 대해 양쪽 코사인 유사도를 원본 벡터로 계산
+#   → 추천 순위가 바뀌므로 오프라인 평가 후 켤 것
+FUSION_MODE = os.getenv("FUSION_MODE", "legacy")
+FUSION_POOL_SIZE = int(os.getenv("FUSION_POOL_SIZE", "50"))  # exact 모드에서 인덱스별 검색 후보 수
+
+def _minmax(x):
+    """열(column)별 min-max 정규화 (전부 비슷하면 중립값 0.5)"""
+    mn, mx = x.min(axis=0), x.max(axis=0)
+    span = mx - mn
+    flat = span < 1e-6
+    return np.where(flat, 0.5, (x - mn) / np.where(flat, 1.0, span))
+
+def _exact_sims(db, pids, query_vec):
+    """pids 각각의 원본 벡터와 query_vec의 코사인 유사도 (인덱스에 없는 상품은 0)"""
+    sims = np.zeros(len(pids), dtype="float32")
+    if db is None or query_vec is None:
+        return sims
+    rows = db["pid_rows"][pids]
+    found = rows >= 0
+    if found.any():
+        q = np.asarray(query_vec, dtype="float32").reshape(-1)
+        q = q / max(np.linalg.norm(q), 1e-12)
+        sims[found] = db["vectors"].reconstruct_batch(rows[found]) @ q
+    return sims
+
+def fuse_candidates_exact(style_items, tpo_items, conflict, db_cache, category, style_vec, tpo_vec, topk=5):
+    """
+    style / tpo 검색 결과의 합집합에 대해
+    양쪽 유사도를 모두 exact 계산 → 정규화 → conflict-aware 가중합 (NumPy 벡터 연산)
+    각 아이템에 style_sim / tpo_sim / fused_score를 기록
+    """
+    merged = {}
+    for item in list(style_items) + list(tpo_items):
+        merged.setdefault(_join_key(item), item)
+    if not merged:
+        return []
+
+    items = list(merged.values())
+    pids = np.array([item["pid"] for item in items], dtype=np.int64)
+
+    sims = np.stack([
+        _exact_sims(db_cache["style"][category], pids, style_vec),
+        _exact_sims(db_cache["tpo"][category], pids, tpo_vec),
+    ], axis=1)
+
+    # conflict-aware 가중치 (alpha: style, beta: tpo)
+    weights = np.array([0.0, 1.0] if conflict else [0.5, 0.5], dtype="float32")
+    fused = _minmax(sims) @ weights
+
+    order = np.argsort(-fused, kind="stable")[:topk]
+    results = []
+    for i in order:
+        item = items[i]
+        item["style_sim"] = float(sims[i, 0])
+        item["tpo_sim"] = float(sims[i, 1])
+        item["fused_score"] = float(fused[i])
+        results.append(item)
+    return results
+
+
 def print_fused_candidates(items, title="FUSED_CANDIDATES"):
     print(f"\n=== {title} (n={len(items)}) ===")
     for i, x in enumerate(items, 1):
@@ -609,7 +1529,19 @@ def print_fused_candidates(items, title="FUSED_CANDIDATES"):
             f"score={x.get('score', 'N/A')}"
         )
 
-def lookup_item_by_id(product_id, candidates):
+def lookup_item_by_id(product_id, candidates, pid_index=None):
+    """
+    pid_index(db_cache["products"][cat]["pid_index"])가 주어지면
+    product_id → pid를 O(1)로 찾은 뒤 int 비교로 후보 조회
+    """
+    if pid_index is not None:
+        pid = pid_index.get(str(product_id))
+        for item in candidates:
+            if pid is not None and item.get("pid") == pid:
+                return item
+        print(f"⚠️ lookup_item_by_id: product_id={product_id} not found")
+        return None
+
     pid = str(product_id)
     for item in candidates:
         if str(item.get("product_id")) == pid:
@@ -654,6 +1586,10 @@ def append_selected_context(selected_context_text: str, chosen_item: dict) -> st
 # 6. update feedback 
 # -----------------------
 
+def init_negatives():
+    return {"fit": [], "pattern": [], "price_threshold": DEFAULT_PRICE_THRESHOLD}
+
+
 def init_hard_constraints():
     return {
         "forced_sub_categories": [],